@@ -0,0 +1,106 @@
+from __future__ import annotations
+import os, sys
+import json
+import argparse
+import platform
+import tempfile
+import time
+
+
+def size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+def mix(value):
+    return {kind: int(weight) for kind, weight in (item.split('=') for item in value.split(','))}
+
+
+def main():
+    import pypdf
+    from .synthetic import FormSpec, DEFAULT_MIX
+    from .scenarios import SCENARIOS, prepare, run_scenario, compare
+    parser = argparse.ArgumentParser('python -m benchmarks', description='Benchmark filling and converting synthetic forms.')
+    parser.add_argument('scenarios', nargs='*', help=f"The scenarios to run, out of {', '.join(SCENARIOS)}. Defaults to all of them.", metavar='scenario')
+    parser.add_argument('--output', '-o', help='File to write the JSON results to, otherwise stdout')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', help='Relative change counted as a regression when comparing to the baseline', type=float, default=.1)
+    parser.add_argument('--iterations', '-n', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+
+    form_group = parser.add_argument_group('synthetic form')
+    form_group.add_argument('--pages', type=int, default=4)
+    form_group.add_argument('--fields-per-page', type=int, default=20)
+    form_group.add_argument('--mix', help="Relative weights of each field type, like 'text=6,textarea=1,checkbox=2,choice=1'", type=mix, default=DEFAULT_MIX)
+    form_group.add_argument('--radio-groups', help='Radio groups per page', type=int, default=1)
+    form_group.add_argument('--radio-options', type=int, default=3)
+    form_group.add_argument('--signatures', help='Signature fields per page', type=int, default=1)
+    form_group.add_argument('--signature-size', help='Pixel size (like 600x200) of a signature image. May be given more than once; the fill scenarios use the first.', type=size, action='append', dest='signature_sizes')
+
+    fill_group = parser.add_argument_group('fill options')
+    fill_group.add_argument('--records', help='Records per iteration of fill_batch', type=int, default=50)
+    fill_group.add_argument('--workers', help='Worker processes for fill_batch', type=int, default=None)
+    fill_group.add_argument('--dpi', type=int, default=200)
+
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario '{name}'")
+    signature_sizes = args.signature_sizes or [(600, 200), (3000, 1000)]
+    spec = FormSpec(
+        pages=args.pages,
+        fields_per_page=args.fields_per_page,
+        mix=args.mix,
+        radio_groups=args.radio_groups,
+        radio_options=args.radio_options,
+        signatures=args.signatures,
+    )
+    options = dict(
+        iterations=args.iterations,
+        warmup=args.warmup,
+        records=args.records,
+        workers=args.workers,
+        dpi=args.dpi,
+        signature_sizes=signature_sizes,
+    )
+    results = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'pypdf': pypdf.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'form': spec.to_dict(),
+            'options': options,
+        },
+        'scenarios': {},
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        prepare(workdir, spec, signature_sizes)
+        for name in args.scenarios or SCENARIOS:
+            # Scenarios about signatures run once for each signature size
+            runs = [(f'{name}[{w}x{h}]', ((w, h),)) for w, h in signature_sizes] if name == 'paste_signature' else [(name, ())]
+            for label, scenario_args in runs:
+                print(f'Running {label}...', file=sys.stderr)
+                results['scenarios'][label] = run_scenario(name, scenario_args, workdir, options)
+
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as file:
+            file.write(output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = 0
+        print(f"\n{'scenario':<32} {'metric':<18} {'baseline':>12} {'current':>12} {'change':>8}", file=sys.stderr)
+        for name, metric, old, new, change, regressed in compare(results, baseline, args.threshold):
+            regressions += regressed
+            print(f"{name:<32} {metric:<18} {old:>12} {new:>12} {change:>+8.1%}{'  REGRESSION' if regressed else ''}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
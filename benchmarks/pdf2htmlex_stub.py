@@ -0,0 +1,83 @@
+"""
+Stand-in for pdf2htmlEX, so that make-html can be benchmarked without it. Writes the same page structure that
+pdf2htmlEX does (with an embedded font, a background image and some text per page), honoring -f, -l and --zoom.
+
+Set PDF2HTMLEX_STUB_DELAY to a number of seconds to spend on each page, to simulate the real conversion time.
+"""
+import os, sys, time
+from pypdf import PdfReader
+
+BACKGROUND = 'iVBORw0KGgo' + 'A' * 20001
+FONT = 'd09GRgABAAAA' + 'B' * 5000
+
+
+def page_html(n, zoom):
+    lines = ''.join(
+        f'<div class="t m0 x1 h2 y{line:x} ff1 fs0 fc0 sc0 ls0 ws0">Page {n} line {line} of some form text</div>'
+        for line in range(1, 40)
+    )
+    return (
+        f'<div id="pf{n:x}" class="pf w0 h0" data-page-no="{n:x}"><div class="pc pc{n:x} w0 h0">'
+        f'<img class="bi x0 y0 w1 h1" alt="" src="data:image/png;base64,{BACKGROUND}"/>{lines}</div>'
+        f'<div class="pi" data-data=\'{{"ctm":[{zoom},0,0,{zoom},0,0]}}\'></div></div>'
+    )
+
+
+def main(argv):
+    options = {}
+    positional = []
+    args = iter(argv)
+    for arg in args:
+        if arg.startswith('-'):
+            options[arg] = next(args)
+        else:
+            positional.append(arg)
+    input_path, output_path = positional
+    page_count = len(PdfReader(input_path).pages)
+    first = int(options.get('-f', 1))
+    last = min(int(options.get('-l', page_count)), page_count)
+    zoom = float(options.get('--zoom', 1))
+    delay = float(os.environ.get('PDF2HTMLEX_STUB_DELAY') or 0)
+    pages = []
+    for n in range(first, last + 1):
+        time.sleep(delay)
+        pages.append(page_html(n, zoom))
+    with open(output_path, 'w') as file:
+        file.write(f'''<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head>
+<meta charset="utf-8"/>
+<meta name="generator" content="pdf2htmlEX"/>
+<style type="text/css">/*! base.min.css */.pf{{position:relative}}</style>
+<style type="text/css">.ff1{{font-family:ff1;}}@font-face{{font-family:ff1;src:url('data:application/font-woff;base64,{FONT}')format("woff");}}.w0{{width:{612 * zoom}px;}}.h0{{height:{792 * zoom}px;}}</style>
+<script>/*! pdf2htmlEX.min.js */var pdf2htmlEX={{}};</script>
+<script>try{{ pdf2htmlEX.defaultViewer = new pdf2htmlEX.Viewer({{}}); }}catch(e){{}}</script>
+<title></title>
+</head>
+<body>
+<div id="sidebar">
+<div id="outline">
+</div>
+</div>
+<div id="page-container">
+{chr(10).join(pages)}
+</div>
+<div class="loading-indicator">
+<img alt="" src="data:image/png;base64,iVBORw0KGgo="/>
+</div>
+</body>
+</html>
+''')
+
+
+def install(directory):
+    """Write an executable wrapper around this stub into `directory`, returning its path to pass as `pdf2html`."""
+    path = os.path.join(directory, 'pdf2htmlEX')
+    with open(path, 'w') as file:
+        file.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" "$@"\n')
+    os.chmod(path, 0o755)
+    return path
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,180 @@
+"""
+The benchmark scenarios, and the harness that times them.
+
+Each scenario is set up against a work directory prepared by `prepare`, and returns the operation to time along with
+how many units of work (e.g. filled records) each call of it does. Every scenario runs in a fresh process, so that
+its peak RSS is its own.
+"""
+from __future__ import annotations
+import os
+import json
+import math
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from multiprocessing import get_context
+from .synthetic import FormSpec, generate_form, generate_signature, data_uri, sample_data
+from . import pdf2htmlex_stub
+
+SCENARIOS = {}
+
+def scenario(func):
+    SCENARIOS[func.__name__] = func
+    return func
+
+
+def prepare(workdir, spec: FormSpec, signature_sizes):
+    """Generate the template, signatures and stand-in pdf2htmlEX output that the scenarios run against."""
+    os.makedirs(workdir, exist_ok=True)
+    pdf, kinds = generate_form(spec)
+    with open(os.path.join(workdir, 'form.pdf'), 'wb') as file:
+        file.write(pdf)
+    with open(os.path.join(workdir, 'kinds.json'), 'w') as file:
+        json.dump(kinds, file)
+    for width, height in signature_sizes:
+        with open(os.path.join(workdir, f'signature-{width}x{height}.png'), 'wb') as file:
+            file.write(generate_signature(width, height))
+    pdf2html = pdf2htmlex_stub.install(workdir)
+    pdf2htmlex_stub.main([os.path.join(workdir, 'form.pdf'), os.path.join(workdir, 'form.raw.html')])
+    return pdf2html
+
+
+def _load(workdir, signature_size=None):
+    with open(os.path.join(workdir, 'kinds.json')) as file:
+        kinds = json.load(file)
+    signature = None
+    if signature_size is not None:
+        with open(os.path.join(workdir, 'signature-{}x{}.png'.format(*signature_size)), 'rb') as file:
+            signature = file.read()
+    return os.path.join(workdir, 'form.pdf'), kinds, signature
+
+
+@scenario
+def fill_single(workdir, options):
+    """Fill one record into an already-parsed template."""
+    from transformer.fill_pdf import get_template
+    template_path, kinds, signature = _load(workdir, options['signature_sizes'][0])
+    data = sample_data(kinds, data_uri(signature))
+    template = get_template(template_path)
+    return lambda: template.fill(BytesIO(), data, dpi=options['dpi']), 1
+
+@scenario
+def fill_cold(workdir, options):
+    """Fill one record from scratch, with nothing cached."""
+    from transformer.fill_pdf import fill, clear_template_cache
+    from transformer.fill_pdf.paste_img import clear_stamp_cache
+    template_path, kinds, signature = _load(workdir, options['signature_sizes'][0])
+    data = sample_data(kinds, data_uri(signature))
+    def op():
+        clear_template_cache()
+        clear_stamp_cache()
+        fill(template_path, BytesIO(), data, dpi=options['dpi'])
+    return op, 1
+
+@scenario
+def fill_batch(workdir, options):
+    """Fill a batch of records to files with `fill_many`."""
+    from transformer.fill_pdf import fill_many
+    template_path, kinds, signature = _load(workdir, options['signature_sizes'][0])
+    signature = data_uri(signature)
+    records = [sample_data(kinds, signature, i) for i in range(options['records'])]
+    output = os.path.join(workdir, 'batch', '{index}.pdf')
+    def op():
+        for result in fill_many(template_path, records, output, workers=options['workers'], dpi=options['dpi']):
+            if result.error is not None:
+                raise RuntimeError(f'Record {result.index} failed: {result.error}')
+    return op, len(records)
+
+@scenario
+def paste_signature(workdir, options, signature_size):
+    """Paste a signature image onto a page, with the stamp cache cleared each time."""
+    from pypdf import PdfWriter
+    from transformer.fill_pdf.paste_img import paste_img, clear_stamp_cache
+    _, _, signature = _load(workdir, signature_size)
+    def op():
+        clear_stamp_cache()
+        writer = PdfWriter()
+        page = writer.add_blank_page(612, 792)
+        paste_img(BytesIO(signature), page, 72, 72, 216, 72, dpi=options['dpi'])
+        writer.write(BytesIO())
+    return op, 1
+
+@scenario
+def process_form(workdir, options):
+    """Post-process pdf2htmlEX output into an HTML form, in memory."""
+    from bs4 import BeautifulSoup
+    from transformer.make_html.process_form import process_form
+    template_path, _, _ = _load(workdir)
+    with open(os.path.join(workdir, 'form.raw.html')) as file:
+        html = file.read()
+    def op():
+        soup = BeautifulSoup(html, 'lxml')
+        process_form(template_path, soup, 1)
+        str(soup)
+    return op, 1
+
+@scenario
+def make_html(workdir, options):
+    """Run make-html end to end, with the stand-in for pdf2htmlEX and no conversion cache."""
+    from transformer.make_html import transform
+    template_path, _, _ = _load(workdir)
+    output = os.path.join(workdir, 'form.html')
+    pdf2html = os.path.join(workdir, 'pdf2htmlEX')
+    return lambda: transform(template_path, output, pdf2html=pdf2html, do_form=True, no_ui=True, cache=False), 1
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of already-sorted values."""
+    return sorted_values[max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)]
+
+def _run(name, args, workdir, options):
+    op, units = SCENARIOS[name](workdir, options, *args)
+    for _ in range(options['warmup']):
+        op()
+    latencies = []
+    for _ in range(options['iterations']):
+        start = time.perf_counter()
+        op()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    total = sum(latencies)
+    # ru_maxrss is in KiB on Linux; take worker processes into account for scenarios that start them
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {
+        'iterations': len(latencies),
+        'units_per_iteration': units,
+        'total_s': round(total, 6),
+        'throughput_per_s': round(units * len(latencies) / total, 3) if total else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'peak_rss_mb': round(peak_rss / 1024, 1),
+    }
+
+def run_scenario(name, args, workdir, options):
+    """Run a scenario in a fresh process, returning its results."""
+    with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(_run, name, args, workdir, options).result()
+
+
+# For each metric, whether bigger numbers are better
+METRICS = {'throughput_per_s': True, 'p50_ms': False, 'p99_ms': False, 'peak_rss_mb': False}
+
+def compare(results, baseline, threshold):
+    """
+    Compare results against a baseline, returning a row for every metric of every scenario in both, as
+    (scenario, metric, baseline value, current value, relative change, whether it regressed by more than `threshold`).
+    """
+    rows = []
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if previous is None:
+            continue
+        for metric, bigger_is_better in METRICS.items():
+            old, new = previous.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            regressed = -change > threshold if bigger_is_better else change > threshold
+            rows.append((name, metric, old, new, change, regressed))
+    return rows
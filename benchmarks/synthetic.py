@@ -0,0 +1,197 @@
+"""
+Generators for synthetic AcroForm PDFs and signature images to benchmark against.
+"""
+from __future__ import annotations
+import base64
+from io import BytesIO
+from itertools import cycle
+from PIL import Image, ImageDraw
+from pypdf import PdfWriter
+from pypdf.generic import (
+    ArrayObject, BooleanObject, DictionaryObject, FloatObject, NameObject, NumberObject, StreamObject, TextStringObject,
+)
+from pypdf.constants import FieldDictionaryAttributes
+
+PAGE_WIDTH = 612
+PAGE_HEIGHT = 792
+
+# Default relative weights of each kind of (non-radio, non-signature) field
+DEFAULT_MIX = {'text': 6, 'textarea': 1, 'checkbox': 2, 'choice': 1}
+
+
+class FormSpec:
+    """The shape of a synthetic form."""
+    def __init__(self, *, pages=4, fields_per_page=20, mix=DEFAULT_MIX, radio_groups=1, radio_options=3, signatures=1):
+        self.pages = pages
+        # Fields of the types in `mix`, on each page
+        self.fields_per_page = fields_per_page
+        self.mix = dict(mix)
+        # Radio groups, and signature fields, on each page
+        self.radio_groups = radio_groups
+        self.radio_options = radio_options
+        self.signatures = signatures
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+def _appearance(writer, width, height, content=b''):
+    stream = StreamObject()
+    stream.set_data(content)
+    stream.update({
+        NameObject('/Type'): NameObject('/XObject'),
+        NameObject('/Subtype'): NameObject('/Form'),
+        NameObject('/BBox'): ArrayObject([FloatObject(0), FloatObject(0), FloatObject(width), FloatObject(height)]),
+    })
+    return writer._add_object(stream)
+
+def _on_off(writer, on_name, width, height):
+    mark = f'0 g 2 2 {width - 4} {height - 4} re f'.encode()
+    return DictionaryObject({NameObject('/N'): DictionaryObject({
+        NameObject(on_name): _appearance(writer, width, height, mark),
+        NameObject('/Off'): _appearance(writer, width, height),
+    })})
+
+def _rect(x, y, width, height):
+    return ArrayObject([FloatObject(x), FloatObject(y), FloatObject(x + width), FloatObject(y + height)])
+
+
+def generate_form(spec: FormSpec):
+    """
+    Generate a PDF form to the given spec, returning its bytes along with a dict of field name to the kind of field
+    ('text', 'textarea', 'checkbox', 'choice', 'radio', or 'signature').
+    """
+    writer = PdfWriter()
+    fields = ArrayObject()
+    kinds = {}
+    weighted = [kind for kind, weight in spec.mix.items() for _ in range(weight)]
+    kind_cycle = cycle(weighted or ['text'])
+    row_count = spec.fields_per_page + spec.radio_groups + spec.signatures
+    row_height = (PAGE_HEIGHT - 72) / max(row_count, 1)
+    height = min(row_height * .8, 24)
+    for page_no in range(spec.pages):
+        page = writer.add_blank_page(PAGE_WIDTH, PAGE_HEIGHT)
+        annots = ArrayObject()
+        rows = iter(range(row_count))
+        def next_y():
+            return PAGE_HEIGHT - 36 - row_height * (next(rows) + 1)
+        def add(widget, field=None):
+            ref = writer._add_object(widget)
+            annots.append(ref)
+            fields.append(ref if field is None else field)
+            return ref
+        for i in range(spec.fields_per_page):
+            kind = next(kind_cycle)
+            name = f'p{page_no}_{kind}_{i}'
+            kinds[name] = kind
+            widget = DictionaryObject({
+                NameObject('/Type'): NameObject('/Annot'),
+                NameObject('/Subtype'): NameObject('/Widget'),
+                NameObject('/F'): NumberObject(4),
+                NameObject('/P'): page.indirect_reference,
+                NameObject('/T'): TextStringObject(name),
+            })
+            y = next_y()
+            if kind == 'checkbox':
+                widget[NameObject('/FT')] = NameObject('/Btn')
+                widget[NameObject('/Rect')] = _rect(72, y, height, height)
+                widget[NameObject('/AP')] = _on_off(writer, '/Yes', height, height)
+                widget[NameObject('/AS')] = NameObject('/Off')
+            else:
+                widget[NameObject('/Rect')] = _rect(72, y, 300, height)
+                widget[NameObject('/DA')] = TextStringObject('/Helv 10 Tf 0 g')
+                if kind == 'choice':
+                    widget[NameObject('/FT')] = NameObject('/Ch')
+                    widget[NameObject('/Ff')] = NumberObject(FieldDictionaryAttributes.FfBits.Combo)
+                    widget[NameObject('/Opt')] = ArrayObject([TextStringObject(f'Option {n}') for n in range(3)])
+                else:
+                    widget[NameObject('/FT')] = NameObject('/Tx')
+                    if kind == 'textarea':
+                        widget[NameObject('/Ff')] = NumberObject(FieldDictionaryAttributes.FfBits.Multiline)
+            add(widget)
+        for i in range(spec.radio_groups):
+            name = f'p{page_no}_radio_{i}'
+            kinds[name] = 'radio'
+            parent = DictionaryObject({
+                NameObject('/FT'): NameObject('/Btn'),
+                NameObject('/Ff'): NumberObject(FieldDictionaryAttributes.FfBits.Radio | FieldDictionaryAttributes.FfBits.NoToggleToOff),
+                NameObject('/T'): TextStringObject(name),
+                NameObject('/Kids'): ArrayObject(),
+            })
+            parent_ref = writer._add_object(parent)
+            y = next_y()
+            for option in range(spec.radio_options):
+                widget = DictionaryObject({
+                    NameObject('/Type'): NameObject('/Annot'),
+                    NameObject('/Subtype'): NameObject('/Widget'),
+                    NameObject('/F'): NumberObject(4),
+                    NameObject('/P'): page.indirect_reference,
+                    NameObject('/Parent'): parent_ref,
+                    NameObject('/Rect'): _rect(72 + option * (height + 12), y, height, height),
+                    NameObject('/AP'): _on_off(writer, f'/Opt{option}', height, height),
+                    NameObject('/AS'): NameObject('/Off'),
+                })
+                ref = writer._add_object(widget)
+                annots.append(ref)
+                parent['/Kids'].append(ref)
+            fields.append(parent_ref)
+        for i in range(spec.signatures):
+            name = f'p{page_no}_signature_{i}'
+            kinds[name] = 'signature'
+            add(DictionaryObject({
+                NameObject('/Type'): NameObject('/Annot'),
+                NameObject('/Subtype'): NameObject('/Widget'),
+                NameObject('/F'): NumberObject(4),
+                NameObject('/P'): page.indirect_reference,
+                NameObject('/T'): TextStringObject(name),
+                NameObject('/FT'): NameObject('/Sig'),
+                NameObject('/Rect'): _rect(72, next_y(), 216, max(height, 36)),
+            }))
+        page[NameObject('/Annots')] = annots
+    helv = writer._add_object(DictionaryObject({
+        NameObject('/Type'): NameObject('/Font'),
+        NameObject('/Subtype'): NameObject('/Type1'),
+        NameObject('/BaseFont'): NameObject('/Helvetica'),
+        NameObject('/Encoding'): NameObject('/WinAnsiEncoding'),
+    }))
+    writer._root_object[NameObject('/AcroForm')] = DictionaryObject({
+        NameObject('/Fields'): fields,
+        NameObject('/NeedAppearances'): BooleanObject(True),
+        NameObject('/DA'): TextStringObject('/Helv 0 Tf 0 g'),
+        NameObject('/DR'): DictionaryObject({NameObject('/Font'): DictionaryObject({NameObject('/Helv'): helv})}),
+    })
+    output = BytesIO()
+    writer.write(output)
+    return output.getvalue(), kinds
+
+
+def generate_signature(width, height, format='PNG'):
+    """Generate a signature-like image of the given pixel size, returning the encoded bytes."""
+    mode = 'RGBA' if format.upper() == 'PNG' else 'RGB'
+    img = Image.new(mode, (width, height), (255, 255, 255, 0) if mode == 'RGBA' else 'white')
+    draw = ImageDraw.Draw(img)
+    points = [(x, height / 2 + (height / 3) * ((x * 7919 // max(width, 1)) % 5 - 2) / 2) for x in range(0, width, max(width // 12, 1))]
+    draw.line(points, fill=(20, 20, 120), width=max(width // 150, 1))
+    output = BytesIO()
+    img.save(output, format)
+    return output.getvalue()
+
+def data_uri(img_data, format='PNG'):
+    return f'data:image/{format.lower()};base64,{base64.b64encode(img_data).decode()}'
+
+
+def sample_data(kinds, signature, record=0):
+    """Build data filling every field of a generated form, with `signature` for every signature field."""
+    data = {}
+    for name, kind in kinds.items():
+        if kind in ('text', 'textarea'):
+            data[name] = f'Record {record} {name}'
+        elif kind == 'checkbox':
+            data[name] = '/Yes' if record % 2 == 0 else '/Off'
+        elif kind == 'choice':
+            data[name] = f'Option {record % 3}'
+        elif kind == 'radio':
+            data[name] = f'/Opt{record % 2}'
+        elif kind == 'signature':
+            data[name] = signature
+    return data
@@ -17,6 +17,13 @@ def main():
     make_html_parser.add_argument('--no-scripts', help='Disable javascript in the output file', action='store_true')
     make_html_parser.add_argument('--no-ui', help='Disable UI elements like the sidebar and loading indicator', action='store_true')
     make_html_parser.add_argument('--do-form', help='Turn form fields into an actual HTML form', action='store_true')
+    make_html_parser.add_argument('--streaming', help='Post-process the output in a single streaming pass, rather than loading it all into memory. By default, only done for large outputs.', action=argparse.BooleanOptionalAction)
+    make_html_parser.add_argument('--no-cache', help='Always run Pdf2HtmlEX, rather than reusing a previous conversion of the same PDF with the same options', action='store_true')
+    make_html_parser.add_argument('--cache-dir', help='Directory to cache conversions in. Defaults to ~/.cache/transformer/make-html')
+    make_html_parser.add_argument('--split-pages', help='Write each page to its own file, loaded as it scrolls into view, next to a lightweight document holding the rest', action='store_true')
+    make_html_parser.add_argument('--asset-dir', help='Move fonts, images, styles and scripts into this directory, shared between documents, naming them by their content')
+    make_html_parser.add_argument('--asset-url', help='URL the --asset-dir is served at. Defaults to its path relative to the output.')
+    make_html_parser.add_argument('--jobs', '-j', help='Split the document into this many page ranges and convert them in parallel', type=int, default=1)
 
     # passthrough args
     make_html_parser.add_argument('--first-page', '-f', type=lambda val: ('-f', val), dest='options', action='append')
@@ -46,6 +53,13 @@ def main():
             no_scripts=args.no_scripts,
             no_ui=args.no_ui,
             do_form=args.do_form,
+            jobs=args.jobs,
+            streaming=args.streaming,
+            split_pages=args.split_pages,
+            asset_dir=args.asset_dir,
+            asset_url=args.asset_url,
+            cache=not args.no_cache,
+            cache_dir=args.cache_dir,
             zoom=int(args.zoom) # todo calculate zoom from fit-width or fit-height too (fit_width / actual_width, fit_height / actual_height)
         )
     make_html_parser.set_defaults(func=do_make_html)
@@ -60,8 +74,39 @@ def main():
     data_group.add_argument('--data-json-stdin', help="Pull data in JSON format from stdin. (Obviously, the pdf cannot be coming from stdin in this case)", action='store_true')
     data_group.add_argument('--data-json', help="The data to fill, as a JSON string")
     data_group.add_argument('--data', help="The data to fill, as key-value pairs", nargs=2, metavar=('key', 'value'), action='append')
+    fill_pdf_parser.add_argument('--dpi', help="Resolution to downsample pasted signature images to, or 0 to embed them at full resolution", type=int, default=200)
+    fill_pdf_parser.add_argument('--flatten', help="Draw the filled fields into the page content and remove the form, so the output can no longer be edited", action='store_true')
+    fill_pdf_parser.add_argument('--optimize', '-O', help="Make the output smaller: 1 merges identical objects and compresses uncompressed streams, 2 also packs objects into compressed object streams, 3 also compresses as hard as possible. Reports the bytes saved.", type=int, choices=range(4), default=0, metavar='LEVEL')
+    fill_pdf_parser.add_argument('--incremental', help="Write the output as the template's original bytes plus an incremental update, rather than rewriting the whole document", action='store_true')
+    data_group.add_argument('--batch', help="Fill each record of a JSON Lines or CSV file into its own PDF. The output is then a name template like 'out/{index}.pdf', or a directory if --key-column is given.", metavar='RECORDS')
+
+    batch_group = fill_pdf_parser.add_argument_group('batch mode')
+    batch_group.add_argument('--key-column', help="Name each output file after this column of the record, rather than formatting the output name")
+    batch_group.add_argument('--workers', help="Number of worker processes to fill with; defaults to one per CPU, or 0 to fill in this process", type=int)
+
+    def do_fill_batch(args):
+        from .fill_pdf import fill_many
+        if args.output is None:
+            raise RuntimeError('An output name template or directory is required in batch mode')
+        in_file = sys.stdin.buffer if args.pdf is None else args.pdf
+        failed = 0
+        saved = 0
+        for result in fill_many(in_file, args.batch, args.output, key=args.key_column, workers=args.workers, dpi=args.dpi or None, incremental=args.incremental, flatten=args.flatten, optimize=args.optimize):
+            for warning in result.warnings:
+                print(f"Record {result.index}: {warning}", file=sys.stderr)
+            if result.error is not None:
+                failed += 1
+                print(f"Record {result.index} failed: {result.error}", file=sys.stderr)
+            saved += result.bytes_saved or 0
+        if args.optimize:
+            print(f"Optimizing saved {saved} bytes", file=sys.stderr)
+        if failed:
+            print(f"{failed} record(s) failed", file=sys.stderr)
+            sys.exit(1)
     
     def do_fill_form(args):
+        if args.batch:
+            return do_fill_batch(args)
         from .fill_pdf import fill
         in_file = sys.stdin.buffer if args.pdf is None else args.pdf
         out_file = sys.stdout.buffer if args.output is None else args.output
@@ -81,10 +126,44 @@ def main():
                 data = load(file)
         else:
             raise RuntimeError('No data source supplied')
-        fill(in_file, out_file, data)
+        saved = fill(in_file, out_file, data, dpi=args.dpi or None, incremental=args.incremental, flatten=args.flatten, optimize=args.optimize)
+        if args.optimize:
+            print(f"Optimizing saved {saved} bytes", file=sys.stderr)
     fill_pdf_parser.set_defaults(func=do_fill_form)
 
+    ###### serve ######
+    serve_parser = subparser.add_parser('serve', description='Run a local HTTP server that fills PDFs on request, keeping templates parsed in memory between requests. POST a JSON object of data to /fill/<template id> to get back the filled PDF.')
+    serve_parser.add_argument('templates', help="Directory of template PDFs, each identified by its filename without the .pdf extension")
+    address_group = serve_parser.add_mutually_exclusive_group()
+    address_group.add_argument('--port', help="TCP port to listen on", type=int, default=8080)
+    address_group.add_argument('--socket', help="Listen on this Unix socket, rather than a TCP port")
+    serve_parser.add_argument('--host', help="Address to listen on", default='127.0.0.1')
+    serve_parser.add_argument('--workers', help="Number of worker processes to fill with; defaults to one per CPU, or 0 to fill in the server process", type=int)
+    serve_parser.add_argument('--queue-size', help="Number of requests allowed to wait for a free worker before turning new ones away; defaults to four per worker", type=int)
+    serve_parser.add_argument('--dpi', help="Resolution to downsample pasted signature images to, or 0 to embed them at full resolution", type=int, default=200)
+    serve_parser.add_argument('--max-body-bytes', help="Largest request body to accept, in bytes; defaults to 16 MiB", type=int)
+
+    def do_serve(args):
+        from .serve import serve
+        serve(args.templates, host=args.host, port=args.port, unix_socket=args.socket, workers=args.workers, queue_size=args.queue_size, dpi=args.dpi or None, max_body_bytes=args.max_body_bytes)
+    serve_parser.set_defaults(func=do_serve)
+
+    ###### profiling ######
+    for subcommand_parser in (make_html_parser, fill_pdf_parser):
+        profile_group = subcommand_parser.add_argument_group('profiling')
+        profile_group.add_argument('--profile', help="When done, print a JSON report of the time spent in each stage to stderr. Stages run in worker processes are not included.", action='store_true')
+        profile_group.add_argument('--profile-memory', help="Like --profile, but also trace the peak memory of each stage. Slows everything down considerably.", action='store_true')
+
     ###### end ######
 
     args = parser.parse_args()
-    args.func(args)
\ No newline at end of file
+    if getattr(args, 'profile', False) or getattr(args, 'profile_memory', False):
+        import json
+        from .instrument import Profiler
+        with Profiler(trace_memory=args.profile_memory) as profiler:
+            try:
+                args.func(args)
+            finally:
+                print(json.dumps(profiler.report(), indent=2), file=sys.stderr)
+    else:
+        args.func(args)
\ No newline at end of file
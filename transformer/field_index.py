@@ -0,0 +1,137 @@
+from __future__ import annotations
+import json
+from io import IOBase
+from pypdf import PdfReader
+from pypdf.constants import FieldDictionaryAttributes, AnnotationDictionaryAttributes
+
+
+class FieldInfo:
+    """A form field: its fully qualified name, type (e.g. '/Tx'), flags, and the widgets that display it."""
+    __slots__ = ('name', 'type', 'flags', 'mapping_name', 'alternate_name', 'widgets')
+
+    def __init__(self, name, type, flags=0, mapping_name=None, alternate_name=None):
+        self.name = name
+        self.type = type
+        self.flags = flags
+        self.mapping_name = mapping_name
+        self.alternate_name = alternate_name
+        self.widgets = []
+
+
+class WidgetInfo:
+    """A single widget annotation of a field, on a (0-based) page, with its rect as (left, bottom, right, top)."""
+    __slots__ = ('field', 'page', 'rect')
+
+    def __init__(self, field, page, rect):
+        self.field = field
+        self.page = page
+        self.rect = rect
+
+    @property
+    def left(self): return self.rect[0]
+    @property
+    def bottom(self): return self.rect[1]
+    @property
+    def width(self): return self.rect[2] - self.rect[0]
+    @property
+    def height(self): return self.rect[3] - self.rect[1]
+
+
+def _optional_str(value):
+    return None if value is None else str(value)
+
+def _qualified_name(field):
+    parts = []
+    while field is not None:
+        if FieldDictionaryAttributes.T in field:
+            parts.append(str(field[FieldDictionaryAttributes.T]))
+        field = field.get(FieldDictionaryAttributes.Parent)
+        field = None if field is None else field.get_object()
+    return '.'.join(reversed(parts))
+
+
+class FieldIndex:
+    """
+    Index of the AcroForm fields of a PDF, built in a single pass over the page annotations.
+
+    `fields` maps each field's fully qualified name to its `FieldInfo`, and `pages` lists the `WidgetInfo`s on each
+    page. An index can be saved to disk and loaded again without needing to parse the PDF.
+    """
+    def __init__(self, page_count=0):
+        self.fields = {}
+        self.pages = [[] for _ in range(page_count)]
+
+    def add_widget(self, field: FieldInfo, widget: WidgetInfo):
+        field = self.fields.setdefault(field.name, field)
+        field.widgets.append(widget)
+        self.pages[widget.page].append(widget)
+
+    @classmethod
+    def from_reader(cls, reader: PdfReader):
+        index = cls(len(reader.pages))
+        for page_no, pdf_page in enumerate(reader.pages):
+            if pdf_page.annotations is None: continue
+            for annot in pdf_page.annotations:
+                annot = annot.get_object()
+                # All field widgets are annotations with type "widget"
+                # See 12.5.6.19 at https://opensource.adobe.com/dc-acrobat-sdk-docs/pdfstandards/PDF32000_2008.pdf
+                if annot.get(AnnotationDictionaryAttributes.Subtype) != "/Widget":
+                    continue
+                # Actual field data *may* use the same dictionary as the widget, but may not.
+                # E.g. for radio groups the parent is the field, and the children are the widgets
+                # Docs seem to indicate that /Parent should be absent when the annotation is the field,
+                # at least as I read it, but in practice this does not seem to actually be the case.
+                # So instead, I'm guessing based on the FT (field type, see 12.7.3.1)
+                if FieldDictionaryAttributes.FT in annot:
+                    field = annot
+                elif FieldDictionaryAttributes.Parent in annot and FieldDictionaryAttributes.FT in annot[FieldDictionaryAttributes.Parent].get_object():
+                    field = annot[FieldDictionaryAttributes.Parent].get_object()
+                else:
+                    # I don't think this should ever happen, but if so I guess skip this widget
+                    continue
+                name = _qualified_name(field)
+                info = index.fields.get(name) or FieldInfo(
+                    name,
+                    str(field[FieldDictionaryAttributes.FT]),
+                    int(field.get(FieldDictionaryAttributes.Ff, 0)),
+                    _optional_str(field.get(FieldDictionaryAttributes.TM)),
+                    _optional_str(field.get(FieldDictionaryAttributes.TU)),
+                )
+                rect = tuple(float(x) for x in annot[AnnotationDictionaryAttributes.Rect])
+                # Normalize, since some PDFs give the corners in the wrong order
+                rect = (min(rect[0], rect[2]), min(rect[1], rect[3]), max(rect[0], rect[2]), max(rect[1], rect[3]))
+                index.add_widget(info, WidgetInfo(name, page_no, rect))
+        return index
+
+    @classmethod
+    def from_pdf(cls, pdf):
+        """Build the index of a PDF file, given as a path or binary stream."""
+        with pdf if isinstance(pdf, IOBase) else open(pdf, 'rb') as pdf_file:
+            return cls.from_reader(PdfReader(pdf_file))
+
+    def to_dict(self):
+        field_nos = {name: i for i, name in enumerate(self.fields)}
+        return {
+            'pages': len(self.pages),
+            'fields': [[f.name, f.type, f.flags, f.mapping_name, f.alternate_name] for f in self.fields.values()],
+            # In page order, so that the order of the widgets on each page survives the round trip
+            'widgets': [[field_nos[w.field], w.page, *w.rect] for page in self.pages for w in page],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls(data['pages'])
+        fields = [FieldInfo(*field) for field in data['fields']]
+        for field_no, page, *rect in data['widgets']:
+            field = fields[field_no]
+            index.add_widget(field, WidgetInfo(field.name, page, tuple(rect)))
+        return index
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as file:
+            return cls.from_dict(json.load(file))
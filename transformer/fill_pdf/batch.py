@@ -0,0 +1,137 @@
+from __future__ import annotations
+import csv
+import json
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from typing import NamedTuple
+from .template import get_template
+
+
+class FillResult(NamedTuple):
+    index: int
+    output: str | None
+    error: str | None = None
+    warnings: tuple = ()
+    # With fill(..., optimize=...), how many bytes optimizing saved
+    bytes_saved: int | None = None
+
+
+def iter_records(records_path):
+    """
+    Lazily read records from a CSV file (by extension), or from a JSON Lines file otherwise.
+
+    JSON lines are yielded unparsed, so that (unless outputs are named by key) the parsing happens, and fails, in
+    whichever worker handles the record.
+    """
+    with open(records_path, 'r', newline='') as file:
+        if records_path.lower().endswith('.csv'):
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield line
+
+
+def _key_path(output, value):
+    """The output file for the record with the given key, which must name a file directly within `output`."""
+    name = str(value)
+    if not name or '..' in name or '/' in name or os.sep in name or (os.altsep and os.altsep in name) or '\0' in name:
+        raise ValueError(f'Key {name!r} cannot be used as a file name')
+    return os.path.join(output, f'{name}.pdf')
+
+def _claim_keys(records, key):
+    """
+    Yield each record with its index, and the error to report rather than filling it if its key was already used by
+    an earlier record. Only JSON lines that have a key need parsing for this, and are passed on parsed.
+    """
+    claimed = set()
+    for index, record in enumerate(records):
+        if key is None:
+            yield index, record, None
+            continue
+        if isinstance(record, str):
+            try:
+                record = json.loads(record)
+            except ValueError:
+                pass # Left for the worker to report
+        if not isinstance(record, dict) or key not in record:
+            yield index, record, None
+            continue
+        value = str(record[key])
+        if value in claimed:
+            yield index, record, f'ValueError: Key {value!r} is used by an earlier record'
+            continue
+        claimed.add(value)
+        yield index, record, None
+
+
+_worker_args = None
+
+def _init_worker(template_pdf, rename_fields, output, key, fill_options):
+    global _worker_args
+    _worker_args = (get_template(template_pdf, rename_fields=rename_fields), output, key, fill_options)
+
+def _fill_record(index, record):
+    template, output, key, fill_options = _worker_args
+    out_path = None
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        try:
+            if isinstance(record, str):
+                record = json.loads(record)
+            if not isinstance(record, dict):
+                raise ValueError(f'Expected an object, got {type(record).__name__}')
+            if key is None:
+                out_path = output.format_map({'index': index, **record})
+            else:
+                record = dict(record)
+                out_path = _key_path(output, record.pop(key))
+            out_dir = os.path.dirname(out_path)
+            if out_dir:
+                os.makedirs(out_dir, exist_ok=True)
+            saved = template.fill(out_path, record, **fill_options)
+        except Exception as e:
+            return FillResult(index, out_path, f'{type(e).__name__}: {e}', tuple(str(w.message) for w in caught))
+    return FillResult(index, out_path, None, tuple(str(w.message) for w in caught), saved)
+
+
+def fill_many(template_pdf, records, output, *, key=None, workers=None, rename_fields={}, **fill_options):
+    """
+    Fill each of a stream of records into the same template, producing one PDF per record.
+
+    `records` is a path to a JSON Lines or CSV file, or any iterable of dicts. Each output file is named by formatting
+    `output` with the record's fields and its `index`, or, if `key` is given, `output` is a directory and the file is
+    named by the record's `key` column (which is not filled into the form). Keys must be usable as file names, and
+    records whose key was already used by an earlier record fail rather than overwrite it. Any other options are passed
+    on to `CompiledTemplate.fill`.
+
+    Work is spread across `workers` processes (default: one per CPU; 0 to fill in this process), with only a bounded
+    number of records in flight at once. Yields a `FillResult` per record as each finishes, in no particular order.
+    Failures are reported in the result rather than raised, so one bad record does not abort the run.
+    """
+    if isinstance(records, str):
+        records = iter_records(records)
+    if hasattr(template_pdf, 'read'):
+        with template_pdf:
+            template_pdf = template_pdf.read()
+    init_args = (template_pdf, rename_fields, output, key, fill_options)
+    if workers == 0:
+        _init_worker(*init_args)
+        for index, record, error in _claim_keys(records, key):
+            yield _fill_record(index, record) if error is None else FillResult(index, None, error)
+        return
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=init_args) as executor:
+        pending = set()
+        for index, record, error in _claim_keys(records, key):
+            if error is not None:
+                yield FillResult(index, None, error)
+                continue
+            if len(pending) >= workers * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(_fill_record, index, record))
+        for future in as_completed(pending):
+            yield future.result()
@@ -0,0 +1,273 @@
+from __future__ import annotations
+import re
+from collections import OrderedDict
+from threading import Lock
+from pypdf import PdfWriter, PageObject, Transformation
+from pypdf.constants import AnnotationDictionaryAttributes, FieldDictionaryAttributes
+from pypdf.generic import ArrayObject, ContentStream, DecodedStreamObject, DictionaryObject, FloatObject, NameObject, StreamObject
+from ..field_index import _qualified_name
+try:
+    # pypdf internals, as of the versions in the readme; without them, all text is left to pypdf to lay out
+    from pypdf._utils import is_char_rtl
+    from pypdf.generic._font import Font
+    if not hasattr(Font, '_get_typographic_maps'):
+        raise ImportError('pypdf fonts have no typographic maps')
+except ImportError:
+    Font = None
+
+# Maximum number of text field layouts kept by each `AppearanceCache`
+APPEARANCE_CACHE_SIZE = 1024
+
+# Widget annotation flag for hidden annotations, which are not drawn when flattening
+_HIDDEN = 2
+
+# The font operator of a default appearance
+_font_operator = re.compile(r'(/[^\s/]+)\s+(-?[\d.]+)\s+Tf')
+# A single line text appearance as pypdf lays it out: the border and text state, the line, and the closing operators
+_single_line = re.compile(rb'(.*\nBT\n[^\n]*\n)(-?[\d.]+) (-?[\d.]+) Td\n(\(.*\)|<[0-9a-f]*>) Tj\n(ET\nQ\nEMC\nQ\n)', re.DOTALL)
+
+
+class TextLayout:
+    """
+    Everything about a text widget's appearance that does not depend on its value: the font and its metrics, the
+    bounding box and matrix, the border and text state that come before the text, and where the line goes. Only
+    single lines of text at a fixed font size are laid out this way; anything else is left to pypdf.
+    """
+    def __init__(self, head, tail, bbox, matrix, font_name, font, font_size, alignment, anchor, y):
+        self.head = head
+        self.tail = tail
+        self.bbox = bbox
+        self.matrix = matrix
+        self.font_name = font_name
+        self.font = font
+        self.font_size = font_size
+        self.reverse_cmap, self.encoding_cmap = font._get_typographic_maps()
+        # The line starts at `anchor` less this fraction of its width: 0 for left aligned, 1/2 centered, 1 right
+        self.alignment = alignment
+        self.anchor = anchor
+        self.y = y
+
+    @classmethod
+    def learn(cls, stream: StreamObject, text, font_size, alignment):
+        """
+        Take the layout from an appearance pypdf generated for `text`, if it is a single line that this class can
+        reproduce exactly. Returns None otherwise.
+        """
+        if Font is None or not cls.fits(text):
+            return None
+        match = _single_line.fullmatch(stream.get_data())
+        fonts = stream.get('/Resources', DictionaryObject()).get_object().get('/Font', DictionaryObject()).get_object()
+        if match is None or len(fonts) != 1:
+            return None
+        font_name, font_ref = next(iter(fonts.items()))
+        font = Font.from_font_resource(font_ref.get_object())
+        if not font.can_encode(text):
+            return None
+        head, x, y, run, tail = match.groups()
+        factor = (0, 0.5, 1)[alignment] if alignment in (0, 1, 2) else 0
+        layout = cls(head, tail, list(stream['/BBox']), stream.get('/Matrix'), font_name, font, font_size, factor, 0, float(y))
+        glyphs = layout.glyphs(text)
+        layout.anchor = float(x) + factor * layout.width(glyphs)
+        return layout if layout.run(glyphs) == run else None
+
+    @staticmethod
+    def fits(text):
+        lines = text.splitlines()
+        return len(lines) == 1 and lines[0] == text and not any(is_char_rtl(char) for char in text)
+
+    def glyphs(self, text):
+        return ''.join(self.reverse_cmap.get(char, char) for char in text)
+
+    def width(self, glyphs):
+        return self.font.get_text_width(glyphs) * self.font_size / 1000
+
+    def run(self, glyphs):
+        """The glyphs encoded as a string operand, as pypdf would."""
+        encoded = b''.join(self.encoding_cmap.get(glyph, bytes((ord(glyph),)) if ord(glyph) < 256 else b'?') for glyph in glyphs)
+        if self.font.sub_type == 'Type0':
+            return b'<' + encoded.hex().encode() + b'>'
+        return b'(' + encoded.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+    def line(self, text):
+        """The operators that draw a line of text, placed as pypdf would."""
+        glyphs = self.glyphs(text)
+        x = self.anchor - self.alignment * self.width(glyphs)
+        return f'{round(x, 3)} {round(self.y, 3)} Td\n'.encode() + self.run(glyphs) + b' Tj\n'
+
+    def appearance(self, text, fonts):
+        """An appearance stream showing `text`, using the font of that name in `fonts`, or None if it does not fit."""
+        if self.font_name not in fonts or not self.fits(text) or not self.font.can_encode(text):
+            return None
+        stream = DecodedStreamObject()
+        stream.set_data(self.head + self.line(text) + self.tail)
+        stream.update({
+            NameObject('/Type'): NameObject('/XObject'),
+            NameObject('/Subtype'): NameObject('/Form'),
+            NameObject('/BBox'): ArrayObject(FloatObject(x) for x in self.bbox),
+            NameObject('/Resources'): DictionaryObject({NameObject('/Font'): DictionaryObject({
+                NameObject(self.font_name): fonts.raw_get(self.font_name)
+            })}),
+        })
+        if self.matrix is not None:
+            stream[NameObject('/Matrix')] = self.matrix
+        return stream
+
+
+class AppearanceCache:
+    """
+    Text layouts for flattened fills, keyed by everything but the value that goes into laying out the text: the
+    default appearance (font, size and color), the size of the rect, the field flags and styling. Widgets that share a
+    style share a layout, which is taken from the first appearance pypdf generates for them; after that, only the line
+    of text itself is laid out for each value.
+    """
+    def __init__(self, max_entries=APPEARANCE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key) -> TextLayout | None:
+        with self._lock:
+            layout = self._entries.get(key)
+            if layout is not None:
+                self._entries.move_to_end(key)
+            return layout
+
+    def store(self, key, layout: TextLayout):
+        with self._lock:
+            self._entries[key] = layout
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def _field(annot):
+    if FieldDictionaryAttributes.FT in annot:
+        return annot
+    parent = annot.get(FieldDictionaryAttributes.Parent)
+    return None if parent is None else parent.get_object()
+
+def _style_key(annot, field, acro_form, page):
+    """Everything about a text widget, other than its value, that affects the appearance pypdf generates for it."""
+    rect = [float(x) for x in annot[AnnotationDictionaryAttributes.Rect]]
+    return (
+        str(annot.get_inherited(AnnotationDictionaryAttributes.DA, acro_form.get(AnnotationDictionaryAttributes.DA, ''))),
+        round(abs(rect[2] - rect[0]), 2),
+        round(abs(rect[3] - rect[1]), 2),
+        int(field.get(FieldDictionaryAttributes.Ff, 0)),
+        int(field.get('/Q', 0)),
+        str(field.get_inherited('/MK', None)),
+        str(field.get('/BS')),
+        annot.get('/MaxLen'),
+        page.get_inherited('/Rotate', 0),
+    )
+
+def _fixed_font_size(style_key):
+    """The font size of a style, or None if it is sized to fit each value, or is a comb field of one cell per character."""
+    default_appearance, _, _, flags, *_ = style_key
+    operators = _font_operator.findall(default_appearance)
+    if not operators or flags & FieldDictionaryAttributes.FfBits.Comb:
+        return None
+    size = float(operators[-1][1])
+    return size if size > 0 else None
+
+def _placement(stream, rect):
+    """The matrix that maps an appearance stream's bounding box onto the annotation's rect; see 12.5.5 of the spec."""
+    matrix = Transformation(tuple(float(x) for x in stream.get('/Matrix', (1, 0, 0, 1, 0, 0))))
+    x1, y1, x2, y2 = (float(x) for x in stream['/BBox'])
+    corners = [matrix.apply_on(corner) for corner in ((x1, y1), (x2, y1), (x1, y2), (x2, y2))]
+    left, bottom = min(x for x, _ in corners), min(y for _, y in corners)
+    right, top = max(x for x, _ in corners), max(y for _, y in corners)
+    rect = [float(x) for x in rect]
+    rect_left, rect_bottom = min(rect[0], rect[2]), min(rect[1], rect[3])
+    scale_x = abs(rect[2] - rect[0]) / (right - left) if right != left else 1
+    scale_y = abs(rect[3] - rect[1]) / (top - bottom) if top != bottom else 1
+    return matrix.translate(-left, -bottom).scale(scale_x, scale_y).translate(rect_left, rect_bottom).ctm
+
+
+def flatten_page(writer: PdfWriter, page: PageObject, values, cache: AppearanceCache):
+    """
+    Fill the given values into the widgets on the page, then draw every widget's appearance into the page content and
+    remove the widgets. Text appearances are laid out from `cache` where possible, and are otherwise generated by pypdf,
+    with their layouts added to it. Returns the number of widgets flattened.
+    """
+    annots = [annot.get_object() for annot in page.get('/Annots', ())]
+    widgets = [annot for annot in annots if annot.get(AnnotationDictionaryAttributes.Subtype) == '/Widget']
+    if not widgets:
+        return 0
+    acro_form = writer.root_object.get('/AcroForm', DictionaryObject()).get_object()
+    fonts = acro_form.get('/DR', DictionaryObject()).get_object().get('/Font', DictionaryObject()).get_object()
+    # Lay out text from cached layouts where there are any, and leave the rest to pypdf
+    appearances = {}
+    generate = {}
+    to_learn = []
+    for annot in widgets:
+        field = _field(annot)
+        if field is None: continue
+        name = _qualified_name(field)
+        field_type = field.get(FieldDictionaryAttributes.FT)
+        combo = field_type == '/Ch' and int(field.get(FieldDictionaryAttributes.Ff, 0)) & FieldDictionaryAttributes.FfBits.Combo
+        if name not in values:
+            # Text that was left for the viewer to lay out still needs an appearance before its widget goes
+            if (field_type == '/Tx' or combo) and '/V' in field and '/AP' not in annot:
+                generate[name] = str(field['/V'])
+            continue
+        if field_type != '/Tx' and not combo:
+            generate[name] = values[name]
+            continue
+        text = str(values[name])
+        key = _style_key(annot, field, acro_form, page)
+        layout = cache.get(key)
+        appearance = None if layout is None else layout.appearance(text, fonts)
+        if appearance is not None:
+            appearances[id(annot)] = appearance
+            continue
+        generate[name] = values[name]
+        if layout is None:
+            font_size = _fixed_font_size(key)
+            if font_size is not None:
+                to_learn.append((key, annot, text, font_size))
+    if generate:
+        writer.update_page_form_field_values(page, generate, auto_regenerate=False)
+    for key, annot, text, font_size in to_learn:
+        if '/AP' in annot and '/N' in annot['/AP'] and cache.get(key) is None:
+            layout = TextLayout.learn(annot['/AP']['/N'].get_object(), text, font_size, key[4])
+            if layout is not None:
+                cache.store(key, layout)
+    # Draw each widget's appearance over the page content
+    resources = page.setdefault(NameObject('/Resources'), DictionaryObject()).get_object()
+    page_xobjects = resources.setdefault(NameObject('/XObject'), DictionaryObject()).get_object()
+    snippets = []
+    names = (NameObject(f'/Flat{n}') for n in range(len(page_xobjects), 1 << 31))
+    for annot in widgets:
+        if int(annot.get('/F', 0)) & _HIDDEN: continue
+        appearance = appearances.get(id(annot))
+        if appearance is None:
+            normal = annot.get('/AP', DictionaryObject()).get_object().get('/N')
+            normal = None if normal is None else normal.get_object()
+            if isinstance(normal, DictionaryObject) and not isinstance(normal, StreamObject):
+                # Checkboxes and radio buttons have an appearance for each state
+                state = annot.get('/AS')
+                normal = None if state is None else normal.get(state)
+                normal = None if normal is None else normal.get_object()
+            appearance = normal
+        if not isinstance(appearance, StreamObject) or '/BBox' not in appearance:
+            continue
+        ref = getattr(appearance, 'indirect_reference', None)
+        if ref is None or ref.pdf is not writer:
+            ref = writer._add_object(appearance)
+        name = next(name for name in names if name not in page_xobjects)
+        page_xobjects[name] = ref
+        matrix = ' '.join(f'{x:.4f}' for x in _placement(appearance, annot[AnnotationDictionaryAttributes.Rect]))
+        snippets.append(f'q {matrix} cm {name} Do Q\n')
+    if snippets:
+        content = page.get_contents()
+        stream = ContentStream(None, writer)
+        snippet = ''.join(snippets).encode()
+        stream.set_data(snippet if content is None else b"q\n" + content.get_data() + b"\nQ\n" + snippet)
+        page.replace_contents(stream)
+    # Then drop the widgets, keeping any other annotations
+    remaining = [annot for annot in page['/Annots'] if annot.get_object().get(AnnotationDictionaryAttributes.Subtype) != '/Widget']
+    if remaining:
+        page[NameObject('/Annots')] = ArrayObject(remaining)
+    else:
+        del page['/Annots']
+    return len(widgets)
@@ -0,0 +1,149 @@
+"""
+Making filled PDFs smaller before they are written, at a CPU cost set by the level:
+
+1. Identical objects (such as the same appearance stream on every copy of a widget) are merged, unreferenced objects
+   are dropped, and uncompressed streams are compressed.
+2. As well, everything other than streams is packed into compressed object streams, with a cross-reference stream in
+   place of the cross-reference table.
+3. As 2, compressing as hard as zlib can.
+"""
+from __future__ import annotations
+from io import BytesIO
+from pypdf import PdfWriter
+from pypdf.generic import ArrayObject, DecodedStreamObject, NameObject, NumberObject, StreamObject
+
+# The highest optimization level
+MAX_OPTIMIZE_LEVEL = 3
+
+# Objects packed into each object stream
+OBJECTS_PER_STREAM = 200
+
+# Uncompressed streams smaller than this (in bytes) are left alone, as not worth compressing
+MIN_COMPRESS_BYTES = 64
+
+
+class _Counter:
+    """A stand-in for an output stream, counting what is written to it."""
+    def __init__(self):
+        self.position = 0
+
+    def write(self, data):
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+
+def written_size(writer: PdfWriter):
+    """The size in bytes of the PDF the writer would write as it is."""
+    counter = _Counter()
+    writer.write_stream(counter)
+    return counter.position
+
+
+def optimize(writer: PdfWriter, level):
+    """Merge identical objects and compress uncompressed streams in the writer's document, in place."""
+    writer.compress_identical_objects(remove_duplicates=True, remove_unreferenced=True)
+    compression = 9 if level >= 3 else -1
+    for i, obj in enumerate(writer._objects):
+        if not isinstance(obj, StreamObject) or '/Filter' in obj:
+            continue
+        data = obj.get_data()
+        if len(data) < MIN_COMPRESS_BYTES:
+            continue
+        plain = DecodedStreamObject()
+        plain.update(obj)
+        plain.set_data(data)
+        compressed = plain.flate_encode(compression)
+        if len(compressed._data) < len(data):
+            compressed.indirect_reference = obj.indirect_reference
+            writer._objects[i] = compressed
+
+
+def write_optimized(writer: PdfWriter, output, level):
+    """Write out the writer's document, using object streams from level 2. Returns the number of bytes written."""
+    counter = _Tee(output)
+    if level < 2 or writer._encryption:
+        writer.write_stream(counter)
+        return counter.position
+    writer._resolve_links()
+    compression = 9 if level >= 3 else -1
+    header = writer.pdf_header if writer.pdf_header >= '%PDF-1.5' else '%PDF-1.5'
+    counter.write(header.encode() + b'\n%\xE2\xE3\xCF\xD3\n')
+    # Cross-reference entries, by object number: (1, offset, 0) for objects written as they are, or
+    # (2, object stream number, index) for those packed into an object stream
+    entries = {}
+    packed = []
+    for idnum, obj in enumerate(writer._objects, start=1):
+        if obj is None:
+            continue
+        if isinstance(obj, StreamObject):
+            entries[idnum] = (1, counter.position, 0)
+            _write_object(counter, idnum, obj)
+        else:
+            packed.append((idnum, obj))
+    next_id = len(writer._objects) + 1
+    for start in range(0, len(packed), OBJECTS_PER_STREAM):
+        chunk = packed[start:start + OBJECTS_PER_STREAM]
+        body = BytesIO()
+        offsets = []
+        for index, (idnum, obj) in enumerate(chunk):
+            offsets.append(f'{idnum} {body.tell()}')
+            obj.write_to_stream(body)
+            body.write(b'\n')
+            entries[idnum] = (2, next_id, index)
+        first = ' '.join(offsets).encode() + b'\n'
+        object_stream = _compressed_stream(first + body.getvalue(), compression, {
+            '/Type': NameObject('/ObjStm'),
+            '/N': NumberObject(len(chunk)),
+            '/First': NumberObject(len(first)),
+        })
+        entries[next_id] = (1, counter.position, 0)
+        _write_object(counter, next_id, object_stream)
+        next_id += 1
+    # The cross-reference stream takes the next number, and holds its own entry
+    xref_id = next_id
+    xref_location = counter.position
+    entries[xref_id] = (1, xref_location, 0)
+    width = max(1, (max(max(entry[1] for entry in entries.values()), xref_id).bit_length() + 7) // 8)
+    rows = []
+    for idnum in range(xref_id + 1):
+        kind, field2, field3 = entries.get(idnum, (0, 0, 65535 if idnum == 0 else 0))
+        rows.append(kind.to_bytes(1, 'big') + field2.to_bytes(width, 'big') + field3.to_bytes(2, 'big'))
+    trailer = {
+        '/Type': NameObject('/XRef'),
+        '/Size': NumberObject(xref_id + 1),
+        '/W': ArrayObject([NumberObject(1), NumberObject(width), NumberObject(2)]),
+        '/Root': writer.root_object.indirect_reference,
+    }
+    if writer._info is not None:
+        trailer['/Info'] = writer._info.indirect_reference
+    if writer._ID is not None:
+        trailer['/ID'] = writer._ID
+    _write_object(counter, xref_id, _compressed_stream(b''.join(rows), compression, trailer))
+    counter.write(f'startxref\n{xref_location}\n%%EOF\n'.encode())
+    return counter.position
+
+
+class _Tee(_Counter):
+    """Counts what is written to the output, so that offsets are from the start of the PDF wherever the output was."""
+    def __init__(self, output):
+        super().__init__()
+        self.output = output
+
+    def write(self, data):
+        self.output.write(data)
+        return super().write(data)
+
+
+def _compressed_stream(data, compression, entries):
+    stream = DecodedStreamObject()
+    stream.set_data(data)
+    stream.update({NameObject(key): value for key, value in entries.items()})
+    return stream.flate_encode(compression)
+
+def _write_object(output, idnum, obj):
+    output.write(f'{idnum} 0 obj\n'.encode())
+    obj.write_to_stream(output)
+    output.write(b'\nendobj\n')
@@ -1,52 +1,192 @@
+from __future__ import annotations
+from collections import OrderedDict
+from hashlib import sha256
+from io import BytesIO, IOBase
+from itertools import count
+from threading import Lock
+import zlib
 from PIL import Image
-from io import BytesIO
-from pypdf import PageObject, PdfReader, Transformation
-
-def paste_img(img, pdf_page:PageObject, x:int, y:int, width:int, height:int):
-    img = Image.open(img)
-    # Scale the image and add margins to perfectly match the destination
-    img_width, img_height = img.size
-    image_ratio = img_height / img_width
-    target_ratio = height / width
-    scale_factor = 1
-    margin_x = 0
-    margin_y = 0
-    if image_ratio > target_ratio: 
-        # Taller ratio than target
-        if img_height > height:
-            # Scale down, and center horizontally
-            scale_factor = height / img_height
-            margin_x = int((width - (img_width * scale_factor)) / 2)
+from pypdf import PageObject
+from pypdf.generic import ContentStream, DictionaryObject, NameObject, NumberObject, StreamObject
+from ..instrument import span
+
+# Maximum total size, in bytes of encoded image data, of the stamps kept by `get_stamp`
+STAMP_CACHE_BYTES = 64 * 1024 * 1024
+# Resolution that pasted images are downsampled to, if they are larger than that at the size they are drawn
+DEFAULT_DPI = 200
+
+
+class Stamp:
+    """
+    An image XObject, along with where to draw it to fit into a particular size of rect. Built once per distinct
+    image, rect size and resolution, then placed into any number of pages and documents.
+
+    JPEGs that need no downsampling are embedded as-is; anything else is decoded, downsampled to `dpi` for the
+    size it will be drawn at (if it is larger than that), and re-encoded.
+    """
+    def __init__(self, img_data: bytes, width, height, dpi=DEFAULT_DPI):
+        img = Image.open(BytesIO(img_data))
+        # Scale the image and add margins to perfectly match the destination
+        img_width, img_height = img.size
+        image_ratio = img_height / img_width
+        target_ratio = height / width
+        scale_factor = 1
+        margin_x = 0
+        margin_y = 0
+        if image_ratio > target_ratio:
+            # Taller ratio than target
+            if img_height > height:
+                # Scale down, and center horizontally
+                scale_factor = height / img_height
+                margin_x = int((width - (img_width * scale_factor)) / 2)
+            else:
+                # Center without scaling
+                margin_x = int((width - img_width) / 2)
+                margin_y = int((height - img_height) / 2)
+        elif image_ratio < target_ratio:
+            # Wider ratio than target
+            if img_width > width:
+                # Scale down, and center vertically
+                scale_factor = width / img_width
+                margin_y = int((height - (img_height * scale_factor)) / 2)
+            else:
+                # Center without scaling
+                margin_x = int((width - img_width) / 2)
+                margin_y = int((height - img_height) / 2)
         else:
-            # Center without scaling
-            margin_x = int((width - img_width) / 2)
-            margin_y = int((height - img_height) / 2)
-    elif image_ratio < target_ratio:
-        # Wider ratio than target
-        if img_width > width:
-            # Scale down, and center vertically 
-            scale_factor = width / img_width
-            margin_y = int((height - (img_height * scale_factor)) / 2)
+            # Same ratio as target
+            if img_height > height:
+                # Scale down
+                scale_factor = height / img_height
+            else:
+                # Center without scaling
+                margin_x = int((width - img_width) / 2)
+                margin_y = int((height - img_height) / 2)
+        # Image space is the unit square, so draw it at its final size in points
+        self.matrix = (img_width * scale_factor, img_height * scale_factor, margin_x, margin_y)
+        # Work out how many pixels are actually needed at the target resolution
+        target_size = (img_width, img_height)
+        if dpi is not None:
+            max_width = max(1, round(self.matrix[0] * dpi / 72))
+            if img_width > max_width:
+                target_size = (max_width, max(1, round(img_height * max_width / img_width)))
+        self.smask = None
+        if img.format == 'JPEG' and img.mode in ('L', 'RGB') and target_size == img.size:
+            # Pass the DCT stream straight through
+            self.image = self._image_stream(img, img_data, '/DCTDecode')
         else:
-            # Center without scaling
-            margin_x = int((width - img_width) / 2)
-            margin_y = int((height - img_height) / 2)
+            is_jpeg = img.format == 'JPEG'
+            if target_size != img.size:
+                if is_jpeg:
+                    # Let the decoder skip the detail we are about to throw away anyway
+                    img.draft(img.mode, target_size)
+                img = img.resize(target_size, Image.LANCZOS)
+            if img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info):
+                img = img.convert('RGBA')
+                self.smask = self._image_stream(img.getchannel('A'), zlib.compress(img.getchannel('A').tobytes()), '/FlateDecode')
+            if img.mode not in ('L', 'RGB'):
+                img = img.convert('RGB')
+            if is_jpeg:
+                encoded = BytesIO()
+                img.save(encoded, 'jpeg', quality=85)
+                self.image = self._image_stream(img, encoded.getvalue(), '/DCTDecode')
+            else:
+                self.image = self._image_stream(img, zlib.compress(img.tobytes()), '/FlateDecode')
+        del img
+        self.size = len(self.image.get_data()) + (0 if self.smask is None else len(self.smask.get_data()))
+
+    @staticmethod
+    def _image_stream(img, data, filter):
+        stream = StreamObject()
+        stream.set_data(data)
+        stream.update({
+            NameObject('/Type'): NameObject('/XObject'),
+            NameObject('/Subtype'): NameObject('/Image'),
+            NameObject('/Width'): NumberObject(img.width),
+            NameObject('/Height'): NumberObject(img.height),
+            NameObject('/ColorSpace'): NameObject('/DeviceGray' if img.mode == 'L' else '/DeviceRGB'),
+            NameObject('/BitsPerComponent'): NumberObject(8),
+            NameObject('/Filter'): NameObject(filter),
+        })
+        return stream
+
+    def add_to(self, pdf):
+        """Copy this stamp's XObject into the given writer, returning a reference to it."""
+        image = self.image.clone(pdf)
+        if self.smask is not None:
+            image[NameObject('/SMask')] = pdf._add_object(self.smask.clone(pdf))
+        return pdf._add_object(image)
+
+
+_stamp_cache = OrderedDict()
+_stamp_cache_size = 0
+_stamp_cache_lock = Lock()
+
+def get_stamp(img, width, height, dpi=DEFAULT_DPI) -> Stamp:
+    """
+    Get the stamp for an image (a path, stream, or bytes) to fit a rect of the given size.
+
+    Stamps are cached by a hash of the image content, the rect size and the resolution, evicting the least recently used once the
+    total exceeds `STAMP_CACHE_BYTES`.
+    """
+    global _stamp_cache_size
+    if isinstance(img, IOBase):
+        img_data = img.read()
+    elif isinstance(img, (bytes, bytearray)):
+        img_data = bytes(img)
     else:
-        # Same ratio as target
-        if img_height > height:
-            # Scale down
-            scale_factor = height / img_height
-        else:
-            # Center without scaling
-            margin_x = int((width - img_width) / 2)
-            margin_y = int((height - img_height) / 2)
-    # Convert the image to a PDF
-    img_as_pdf = BytesIO()
-    img.save(img_as_pdf, 'pdf')
-    del img
-    stamp_pdf = PdfReader(img_as_pdf)
-    # Overlay the PDF version of the image over the page
-    pdf_page.merge_transformed_page(
-        stamp_pdf.pages[0],
-        Transformation().scale(scale_factor, scale_factor).translate(x+margin_x, y+margin_y)
-    )
\ No newline at end of file
+        with open(img, 'rb') as file:
+            img_data = file.read()
+    key = (sha256(img_data).hexdigest(), round(width, 2), round(height, 2), dpi)
+    with _stamp_cache_lock:
+        stamp = _stamp_cache.get(key)
+        if stamp is not None:
+            _stamp_cache.move_to_end(key)
+            return stamp
+    with span('paste_img.encode', image_bytes=len(img_data)) as current:
+        stamp = Stamp(img_data, width, height, dpi)
+        current.count('stamp_bytes', stamp.size)
+    with _stamp_cache_lock:
+        if key not in _stamp_cache:
+            _stamp_cache[key] = stamp
+            _stamp_cache_size += stamp.size
+        while _stamp_cache_size > STAMP_CACHE_BYTES and len(_stamp_cache) > 1:
+            _, evicted = _stamp_cache.popitem(last=False)
+            _stamp_cache_size -= evicted.size
+    return stamp
+
+def clear_stamp_cache():
+    global _stamp_cache_size
+    with _stamp_cache_lock:
+        _stamp_cache.clear()
+        _stamp_cache_size = 0
+
+
+@span('paste_img')
+def paste_img(img, pdf_page:PageObject, x:int, y:int, width:int, height:int, *, dpi=DEFAULT_DPI, xobjects=None):
+    """
+    Paste an image onto a page, fit and centered within the given rect, downsampled to `dpi` (or not at all, if None).
+
+    `xobjects` maps stamps to the XObjects already added to the page's document. Pass the same dict for every page of
+    a document so that repeated placements of an image share a single copy of it.
+    """
+    stamp = get_stamp(img, width, height, dpi)
+    pdf = pdf_page.indirect_reference.pdf
+    if xobjects is None:
+        xobjects = {}
+    if stamp not in xobjects:
+        xobjects[stamp] = stamp.add_to(pdf)
+    ref = xobjects[stamp]
+    # Register the XObject with the page, under the name it already has there or else one that is free
+    resources = pdf_page.setdefault(NameObject('/Resources'), DictionaryObject()).get_object()
+    page_xobjects = resources.setdefault(NameObject('/XObject'), DictionaryObject()).get_object()
+    names = (NameObject(f'/Stamp{n}') for n in count())
+    name = next(name for name in names if name not in page_xobjects or page_xobjects.raw_get(name) == ref)
+    page_xobjects[name] = ref
+    # Then draw it over the existing content
+    w, h, margin_x, margin_y = stamp.matrix
+    snippet = f"q {w:.4f} 0 0 {h:.4f} {x + margin_x:.4f} {y + margin_y:.4f} cm {name} Do Q\n".encode()
+    content = pdf_page.get_contents()
+    stream = ContentStream(None, pdf)
+    stream.set_data(snippet if content is None else b"q\n" + content.get_data() + b"\nQ\n" + snippet)
+    pdf_page.replace_contents(stream)
@@ -0,0 +1,204 @@
+from __future__ import annotations
+import os
+import mmap
+import warnings
+from collections import OrderedDict
+from hashlib import sha256
+from io import IOBase, BytesIO
+from threading import Lock
+from pypdf import PdfReader, PdfWriter, PageRange
+from ..field_index import FieldIndex
+from ..instrument import span
+from .paste_img import paste_img, DEFAULT_DPI
+from . import optimize as optimizer
+
+# Maximum number of compiled templates kept by `get_template`
+TEMPLATE_CACHE_SIZE = 32
+
+
+class CompiledTemplate:
+    """
+    A template PDF that has been parsed once, and can then be filled any number of times.
+
+    Keeps the parsed reader, the field index, the alias map built from `rename_fields`, and the signature widgets on
+    each page, so that each fill only has to do the work specific to its own record. A previously saved `FieldIndex`
+    of the template may be given to skip indexing it again.
+    """
+    def __init__(self, template_pdf, *, rename_fields={}, field_index=None):
+        if isinstance(template_pdf, (bytes, bytearray)):
+            data = bytes(template_pdf)
+        elif isinstance(template_pdf, IOBase):
+            with template_pdf:
+                data = template_pdf.read()
+        else:
+            # Map files rather than reading them, so that only the parts actually used are paged in, and processes
+            # filling the same template share the memory. Replace templates by renaming over them, not in place.
+            with open(template_pdf, 'rb') as pdf_file:
+                data = mmap.mmap(pdf_file.fileno(), 0, access=mmap.ACCESS_READ)
+        # Kept to write out as-is when filling incrementally
+        self.data = data
+        with span('template.parse', bytes=len(data)) as current:
+            self.reader = PdfReader(BytesIO(data) if isinstance(data, bytes) else data)
+            current.count('pages', len(self.reader.pages))
+        if field_index is None:
+            with span('template.index') as current:
+                field_index = FieldIndex.from_reader(self.reader)
+                current.count('fields', len(field_index.fields))
+        self.index = field_index
+        self.fields = self.index.fields
+        self.real_names = {v:k for k,v in rename_fields.items()}
+        # Template page number -> signature widgets on that page
+        self.signature_widgets = {}
+        for page_no, widgets in enumerate(self.index.pages):
+            for widget in widgets:
+                if self.fields[widget.field].type == "/Sig":
+                    self.signature_widgets.setdefault(page_no, []).append(widget)
+        # Text layouts for flattened fills, reused by later fills; created by the first of them
+        self.appearances = None
+        # PdfReader is not safe to use from several threads at once, and appending pages reads from it
+        self._lock = Lock()
+
+    def split_data(self, data):
+        """Split incoming data into values to fill and images to paste, based on the associated field type."""
+        fillable = {}
+        imgs_to_paste = {}
+        for name, value in data.items():
+            dealiased_name = self.real_names.get(name, name)
+            field = self.fields.get(dealiased_name)
+            if not field:
+                warnings.warn(f"Data field '{name}' not found in template PDF or alias map, skipping")
+                continue
+            if field.type == "/Sig":
+                imgs_to_paste[dealiased_name] = value
+            else:
+                fillable[dealiased_name] = value
+        return fillable, imgs_to_paste
+
+    @span('fill')
+    def fill(self, output_pdf, data, *, output_pages=None, dpi=DEFAULT_DPI, incremental=False, flatten=False, optimize=0):
+        """
+        Fill the data into a copy of the template, writing it to `output_pdf` (a path or binary stream).
+
+        If `optimize` (a level from 1 to `MAX_OPTIMIZE_LEVEL`; see `transformer.fill_pdf.optimize`), the output is made
+        smaller before it is written, and the number of bytes saved is returned.
+
+        If `flatten`, the appearance of every field is drawn into the page content, and the form itself is removed.
+
+        If `incremental`, the output is the template's original bytes followed by an incremental update holding only
+        the objects the fill added or changed, rather than a rewrite of the whole document. This is much less work
+        for large templates, and leaves the original document intact, but cannot drop pages with `output_pages`.
+        """
+        fillable, imgs_to_paste = self.split_data(data)
+        if incremental and output_pages is not None:
+            raise ValueError("output_pages cannot be used with an incremental fill")
+        if incremental and optimize:
+            raise ValueError("An incremental fill cannot be optimized")
+        if output_pages is None:
+            output_pages = PageRange(':')
+        elif not isinstance(output_pages, PageRange):
+            output_pages = PageRange(output_pages)
+        page_nos = range(*output_pages.indices(len(self.reader.pages)))
+        with span('fill.append', pages=len(page_nos)), self._lock:
+            if incremental:
+                writer = PdfWriter(self.reader, incremental=True)
+            else:
+                writer = PdfWriter()
+                writer.append(self.reader, pages=output_pages)
+        if flatten:
+            # Imported here, as flattening leans on pypdf internals that plain fills have no need of
+            from .flatten import AppearanceCache, flatten_page
+            with self._lock:
+                if self.appearances is None:
+                    self.appearances = AppearanceCache()
+        # Populate the data into the PDF
+        xobjects = {}
+        for page, page_no in zip(writer.pages, page_nos):
+            # Only look up the fields that are actually on this page; pypdf compares every widget against every value
+            page_widgets = self.index.pages[page_no]
+            page_values = {widget.field: fillable[widget.field] for widget in page_widgets if widget.field in fillable}
+            if page_values and not flatten:
+                with span('fill.update_fields', widgets=len(page_widgets), fields_filled=len(page_values)):
+                    writer.update_page_form_field_values(page, page_values)
+            widgets = [widget for widget in self.signature_widgets.get(page_no, ()) if imgs_to_paste.get(widget.field)]
+            if widgets:
+                with span('fill.signatures', signatures=len(widgets)):
+                    for widget in widgets:
+                        path = imgs_to_paste[widget.field]
+                        if path.startswith('data:'):
+                            # embedded base64
+                            from base64 import b64decode
+                            _, path = path.split(',', 2)
+                            path = BytesIO(b64decode(path))
+                        paste_img(path, page, widget.left, widget.bottom, widget.width, widget.height, dpi=dpi, xobjects=xobjects)
+            if flatten:
+                with span('fill.flatten', fields_filled=len(page_values)) as current:
+                    current.count('widgets', flatten_page(writer, page, page_values, self.appearances))
+        if flatten and '/AcroForm' in writer.root_object:
+            del writer.root_object['/AcroForm']
+        saved = None
+        if optimize:
+            with span('fill.optimize') as current:
+                size = optimizer.written_size(writer)
+                current.count('bytes_before', size)
+                optimizer.optimize(writer, optimize)
+        # Save output PDF
+        with span('fill.write') as current:
+            if isinstance(output_pdf, IOBase):
+                written = self._write(writer, output_pdf, incremental, optimize)
+            else:
+                with open(output_pdf, "wb") as output:
+                    written = self._write(writer, output, incremental, optimize)
+            if optimize:
+                saved = size - written
+                current.count('bytes_saved', saved)
+        return saved
+
+    def _write(self, writer: PdfWriter, output, incremental, optimize):
+        if optimize:
+            return optimizer.write_optimized(writer, output, optimize)
+        if not incremental:
+            writer.write(output)
+            return
+        # PdfWriter.write would copy the original bytes out of the reader's stream, which is shared with other fills
+        output.write(memoryview(self.data))
+        if writer.list_objects_in_increment():
+            writer._write_increment(output)
+        output.flush()
+
+
+_template_cache = OrderedDict()
+_template_cache_lock = Lock()
+
+def get_template(template_pdf, *, rename_fields={}, field_index=None) -> CompiledTemplate:
+    """
+    Get a compiled template, reusing a previously compiled one where possible.
+
+    Paths are cached by path and modification time, and streams by a hash of their content. At most
+    `TEMPLATE_CACHE_SIZE` templates are kept, evicting the least recently used.
+    """
+    if isinstance(template_pdf, CompiledTemplate):
+        return template_pdf
+    aliases = tuple(sorted(rename_fields.items()))
+    if isinstance(template_pdf, IOBase):
+        with template_pdf:
+            template_pdf = template_pdf.read()
+    if isinstance(template_pdf, (bytes, bytearray)):
+        key = (sha256(template_pdf).hexdigest(), aliases)
+    else:
+        stat = os.stat(template_pdf)
+        key = (os.path.abspath(template_pdf), stat.st_mtime_ns, stat.st_size, aliases)
+    with _template_cache_lock:
+        template = _template_cache.get(key)
+        if template is not None:
+            _template_cache.move_to_end(key)
+            return template
+    template = CompiledTemplate(template_pdf, rename_fields=rename_fields, field_index=field_index)
+    with _template_cache_lock:
+        _template_cache[key] = template
+        while len(_template_cache) > TEMPLATE_CACHE_SIZE:
+            _template_cache.popitem(last=False)
+    return template
+
+def clear_template_cache():
+    with _template_cache_lock:
+        _template_cache.clear()
@@ -0,0 +1,153 @@
+"""
+Lightweight instrumentation of the stages of filling and converting forms.
+
+Each stage runs in a named `span`, recording its wall time, counts of the work it did (e.g. fields filled), and, if
+tracemalloc is tracing, its peak traced memory. Finished spans are passed to every hook added with `add_hook`; with no
+hooks, spans cost next to nothing. `Profiler` is a hook that collects the spans into a JSON-friendly report.
+"""
+from __future__ import annotations
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+
+_hooks = []
+_current: ContextVar[Span | None] = ContextVar('current_span', default=None)
+
+
+class Span:
+    """
+    A named stage: its wall time in seconds, counts, nested spans, and (if traced) how far in bytes the traced memory
+    peaked above what it was when the span started.
+    """
+    __slots__ = ('name', 'parent', 'children', 'counts', 'elapsed', 'memory_peak', '_start', '_start_memory', '_child_peak')
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.children = []
+        self.counts = {}
+        self.elapsed = None
+        self.memory_peak = None
+        self._child_peak = 0
+
+    def count(self, key, n=1):
+        self.counts[key] = self.counts.get(key, 0) + n
+
+    def to_dict(self):
+        data = {'name': self.name, 'wall_ms': round(self.elapsed * 1000, 3)}
+        if self.counts:
+            data['counts'] = self.counts
+        if self.memory_peak is not None:
+            data['memory_peak_bytes'] = self.memory_peak
+        if self.children:
+            data['children'] = [child.to_dict() for child in self.children]
+        return data
+
+
+class _NullSpan:
+    """Stands in for a span when nothing is listening."""
+    __slots__ = ()
+    def count(self, key, n=1): pass
+
+_null_span = _NullSpan()
+
+
+def add_hook(hook):
+    """Call `hook(span)` with every span as it finishes, in whatever thread it ran in."""
+    _hooks.append(hook)
+    return hook
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+@contextmanager
+def span(name, **counts):
+    """Run the enclosed code as a span called `name`, yielding the span so that counts can be added to it."""
+    if not _hooks:
+        yield _null_span
+        return
+    parent = _current.get()
+    current = Span(name, parent)
+    current.counts.update(counts)
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        # The peak is global, so fold what the parent has seen so far into it before starting over
+        if parent is not None:
+            parent._child_peak = max(parent._child_peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        current._start_memory = tracemalloc.get_traced_memory()[0]
+    token = _current.set(current)
+    current._start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.elapsed = time.perf_counter() - current._start
+        _current.reset(token)
+        if tracing and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], current._child_peak)
+            current.memory_peak = peak - current._start_memory
+            if parent is not None:
+                parent._child_peak = max(parent._child_peak, peak)
+        if parent is not None:
+            parent.children.append(current)
+        for hook in list(_hooks):
+            hook(current)
+
+
+class Profiler:
+    """
+    Collects the spans run while active, and reports them as JSON-friendly data. If `trace_memory`, tracemalloc is
+    started for the duration so that spans also record their peak memory.
+    """
+    def __init__(self, *, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.spans = []
+        self._lock = Lock()
+        self._started_tracing = False
+
+    def __call__(self, finished):
+        # Only top-level spans are kept; the rest are reachable through them
+        if finished.parent is None:
+            with self._lock:
+                self.spans.append(finished)
+
+    def __enter__(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        add_hook(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        remove_hook(self)
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def stages(self):
+        """Totals for each span name: how many times it ran, its total and maximum wall time, and summed counts."""
+        stages = {}
+        def visit(current):
+            stage = stages.setdefault(current.name, {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            stage['calls'] += 1
+            stage['total_ms'] += current.elapsed * 1000
+            stage['max_ms'] = max(stage['max_ms'], current.elapsed * 1000)
+            if current.memory_peak is not None:
+                stage['memory_peak_bytes'] = max(stage.get('memory_peak_bytes', 0), current.memory_peak)
+            for key, n in current.counts.items():
+                counts = stage.setdefault('counts', {})
+                counts[key] = counts.get(key, 0) + n
+            for child in current.children:
+                visit(child)
+        for root in self.spans:
+            visit(root)
+        for stage in stages.values():
+            stage['total_ms'] = round(stage['total_ms'], 3)
+            stage['max_ms'] = round(stage['max_ms'], 3)
+        return stages
+
+    def report(self):
+        return {'stages': self.stages(), 'spans': [root.to_dict() for root in self.spans]}
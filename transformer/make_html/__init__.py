@@ -1,48 +1,155 @@
 from __future__ import annotations
 import os, sys
+import asyncio
+import signal
+import warnings
 from subprocess import run
+from contextvars import copy_context
+from functools import partial
+from weakref import WeakKeyDictionary
 from bs4 import BeautifulSoup
 from io import IOBase, TextIOBase
+from contextlib import ExitStack, contextmanager
 import tempfile
 from shutil import copyfileobj
-from string import Template
+from ..instrument import span
 
-def transform(input_path, output_path, *, pdf2html, pdf2html_options=[], no_scripts=False, no_ui=False, do_form=False, zoom=1):
-    if pdf2html is None:
-        pdf2html = os.path.join(os.path.dirname(__file__), '../pdf2htmlex.appimage')
-    if not os.path.isfile(pdf2html):
-        print("Cannot run pdf2html; path is not valid", file=sys.stderr)
-        exit(1)
-    try:
-        temps = []
-        if isinstance(input_path, TextIOBase):
-            temp_in = tempfile.NamedTemporaryFile('w')
-            copyfileobj(input_path, temp_in)
-            input_path = temp_in.name
-            temp_in.close()
-            temps.append(input_path)
-        elif isinstance(input_path, IOBase):
-            temp_in = tempfile.NamedTemporaryFile('wb')
-            copyfileobj(input_path, temp_in)
-            input_path = temp_in.name
-            temp_in.close()
-            temps.append(input_path)
-        output_file = None
-        if isinstance(output_path, IOBase):
-            output_file = output_path
-            output_path = tempfile.mktemp()
-            temps.append(output_path)
-        result = run([
-            pdf2html,
-            *pdf2html_options,
-            input_path,
-            output_path
-        ])
-        if result.returncode != 0:
-            exit(result.returncode)
-        with open(output_path, 'r+') as file:
-            soup = BeautifulSoup(file.read(), 'lxml')
-            placeholder_replacements = {}
+# pdf2htmlEX output larger than this (in bytes) is post-processed with the streaming rewriter, unless told otherwise
+STREAMING_THRESHOLD = 8 * 1024 * 1024
+
+# Default number of pdf2htmlEX processes `transform_async` runs at once, in each event loop
+MAX_CONCURRENT_CONVERSIONS = os.cpu_count() or 1
+
+_semaphores: WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] = WeakKeyDictionary()
+
+
+class ConversionError(Exception):
+    """pdf2htmlEX failed to convert the PDF."""
+    def __init__(self, returncode):
+        super().__init__(f'pdf2htmlEX exited with code {returncode}')
+        self.returncode = returncode
+
+
+class _Conversion:
+    """
+    The state and steps of one conversion, either side of running pdf2htmlEX, shared by `transform` and
+    `transform_async`. Anything set up to run pdf2htmlEX is cleaned up when `cleanup` is closed.
+    """
+    def __init__(self, input_path, output_path, *, pdf2html, pdf2html_options, no_scripts, no_ui, do_form, zoom, jobs, streaming, cache, cache_dir, field_index, split_pages, asset_dir, asset_url):
+        if split_pages and isinstance(output_path, IOBase):
+            raise ValueError('Splitting pages needs an output path, rather than a stream, to put the pages next to')
+        if split_pages and no_scripts:
+            raise ValueError('Splitting pages needs a script to load the pages, so cannot be combined with no_scripts')
+        self.assets = None
+        if asset_dir is not None:
+            from .assets import AssetStore
+            if asset_url is None:
+                if isinstance(output_path, IOBase):
+                    raise ValueError('Writing to a stream with shared assets needs the URL of the asset directory')
+                asset_url = os.path.relpath(asset_dir, os.path.dirname(os.path.abspath(output_path))).replace(os.sep, '/')
+            self.assets = AssetStore(asset_dir, asset_url)
+        # Whether the finished document still needs reworking before it can be written out
+        self.finish = self.assets is not None or split_pages
+        self.input_path = input_path
+        self.output_path = output_path
+        self.output_file = None
+        self.pass_fds = ()
+        self.pdf2html = pdf2html
+        self.pdf2html_options = pdf2html_options
+        self.no_scripts = no_scripts
+        self.no_ui = no_ui
+        self.do_form = do_form
+        self.zoom = zoom
+        self.jobs = jobs
+        self.streaming = streaming
+        self.cache = cache
+        self.cache_dir = cache_dir
+        self.field_index = field_index
+        self.split_pages = split_pages
+        self.cleanup = ExitStack()
+
+    def prepare(self):
+        """Give pdf2htmlEX paths to read from and write to, in place of any streams."""
+        if isinstance(self.input_path, IOBase):
+            self.input_path, self.pass_fds = self.cleanup.enter_context(_input_file(self.input_path))
+        if isinstance(self.output_path, IOBase):
+            self.output_file = self.output_path
+            # pdf2htmlEX needs somewhere to write to; keep it in memory where there is a tmpfs to do so
+            output_dir = self.cleanup.enter_context(tempfile.TemporaryDirectory(prefix='transformer-', dir=_tmpfs()))
+            self.output_path = os.path.join(output_dir, 'output.html')
+
+    def lookup(self):
+        """Check the cache for this conversion, writing out the cached result and returning True if there is one."""
+        self.conversion_cache = None
+        if not self.cache:
+            return False
+        from .cache import ConversionCache
+        try:
+            self.conversion_cache = ConversionCache(self.cache_dir)
+        except OSError as e:
+            return self._cache_failed(e)
+        with span('make_html.cache_lookup') as current:
+            self.cache_key = self.conversion_cache.key(self.input_path, self.pdf2html, self.pdf2html_options, zoom=self.zoom, no_scripts=self.no_scripts, no_ui=self.no_ui, do_form=self.do_form)
+            try:
+                if not self.conversion_cache.fetch(self.cache_key, self.output_path if self.finish else self.output_file or self.output_path):
+                    return False
+            except OSError as e:
+                return self._cache_failed(e)
+            current.count('cache_hits')
+            if self.finish:
+                _finish_file(self.output_path, self.output_file, assets=self.assets, split_pages=self.split_pages)
+            return True
+
+    def cache_store(self, store, *args):
+        """Store the finished conversion with the given method of the cache, if it is in use."""
+        if self.conversion_cache is None:
+            return
+        with span('make_html.cache_store'):
+            try:
+                store(self.cache_key, *args)
+            except OSError as e:
+                self._cache_failed(e)
+
+    def _cache_failed(self, error):
+        # The cache is only ever an optimization, so carry on without it
+        warnings.warn(f'Not using the make-html cache: {error}')
+        self.conversion_cache = None
+        return False
+
+    def command(self, options=None, output_path=None):
+        """The pdf2htmlEX command line, optionally with other options or output path (as when converting shards)."""
+        return [self.pdf2html, *(self.pdf2html_options if options is None else options), self.input_path, output_path or self.output_path]
+
+    def post_process(self):
+        """Turn pdf2htmlEX's output into the finished document, and write it out."""
+        input_path, output_path, output_file = self.input_path, self.output_path, self.output_file
+        no_scripts, no_ui, do_form, zoom = self.no_scripts, self.no_ui, self.do_form, self.zoom
+        conversion_cache, finish, field_index = self.conversion_cache, self.finish, self.field_index
+        if do_form and field_index is None:
+            from ..field_index import FieldIndex
+            with span('make_html.index_fields') as current:
+                field_index = FieldIndex.from_pdf(input_path)
+                current.count('fields', len(field_index.fields))
+        html_size = os.path.getsize(output_path)
+        streaming = self.streaming
+        if streaming is None:
+            # Splitting and extracting assets work from the parsed document, so there is nothing to gain from streaming first
+            streaming = html_size > STREAMING_THRESHOLD and not finish
+        if streaming:
+            # If caching or finishing, the result needs to land in a file before going to the output stream
+            with span('make_html.stream_rewrite', html_bytes=html_size):
+                _rewrite_streaming(field_index, output_path, None if conversion_cache or finish else output_file, no_scripts=no_scripts, no_ui=no_ui, do_form=do_form, zoom=zoom)
+            if conversion_cache is not None:
+                self.cache_store(conversion_cache.store, output_path)
+            if finish:
+                _finish_file(output_path, output_file, assets=self.assets, split_pages=self.split_pages)
+            elif conversion_cache is not None and output_file is not None:
+                with span('make_html.write'), open(output_path, 'r') as file:
+                    copyfileobj(file, output_file)
+            return
+        with open(output_path, 'r' if output_file is not None else 'r+') as file:
+            with span('make_html.parse', html_bytes=html_size):
+                soup = BeautifulSoup(file.read(), 'lxml')
 
             if no_scripts:
                 for script in soup.find_all('script'):
@@ -55,15 +162,178 @@ def transform(input_path, output_path, *, pdf2html, pdf2html_options=[], no_scri
             
             if do_form:
                 from .process_form import process_form
-                placeholder_replacements.update(process_form(input_path, soup, zoom))
+                process_form(field_index, soup, zoom)
             
-            file.seek(0)
-            print(placeholder_replacements)
-            file.write(Template(str(soup)).safe_substitute(placeholder_replacements))
-            file.truncate()
-            if output_file is not None:
-                file.seek(0)
-                copyfileobj(file, output_file)
-    finally:
-        for file in temps:
-            os.remove(file)
\ No newline at end of file
+            with span('make_html.write'):
+                # The cache keeps the document as it was before finishing
+                html = str(soup) if conversion_cache is not None or not finish else None
+                if finish:
+                    _finish(soup, output_file or output_path, source_dir=os.path.dirname(output_path), assets=self.assets, split_pages=self.split_pages)
+                elif output_file is not None:
+                    # Straight to the output stream, without another trip through the file
+                    output_file.write(html)
+                else:
+                    file.seek(0)
+                    file.write(html)
+                    file.truncate()
+        if conversion_cache is not None:
+            self.cache_store(conversion_cache.store_html, html)
+
+
+@span('make_html')
+def transform(input_path, output_path, *, pdf2html, pdf2html_options=[], no_scripts=False, no_ui=False, do_form=False, zoom=1, jobs=1, streaming=None, cache=True, cache_dir=None, field_index=None, split_pages=False, asset_dir=None, asset_url=None):
+    if pdf2html is None:
+        pdf2html = os.path.join(os.path.dirname(__file__), '../pdf2htmlex.appimage')
+    if not os.path.isfile(pdf2html):
+        print("Cannot run pdf2html; path is not valid", file=sys.stderr)
+        exit(1)
+    conversion = _Conversion(input_path, output_path, pdf2html=pdf2html, pdf2html_options=pdf2html_options, no_scripts=no_scripts, no_ui=no_ui, do_form=do_form, zoom=zoom, jobs=jobs, streaming=streaming, cache=cache, cache_dir=cache_dir, field_index=field_index, split_pages=split_pages, asset_dir=asset_dir, asset_url=asset_url)
+    with conversion.cleanup:
+        conversion.prepare()
+        if conversion.lookup():
+            return
+        with span('make_html.pdf2htmlex', jobs=jobs):
+            if jobs > 1:
+                from .shard import run_sharded
+                returncode = run_sharded(pdf2html, pdf2html_options, conversion.input_path, conversion.output_path, jobs, pass_fds=conversion.pass_fds)
+            else:
+                returncode = run(conversion.command(), pass_fds=conversion.pass_fds).returncode
+        if returncode != 0:
+            exit(returncode)
+        conversion.post_process()
+
+
+async def transform_async(input_path, output_path, *, pdf2html, pdf2html_options=[], no_scripts=False, no_ui=False, do_form=False, zoom=1, jobs=1, streaming=None, cache=True, cache_dir=None, field_index=None, split_pages=False, asset_dir=None, asset_url=None, timeout=None, semaphore=None, executor=None):
+    """
+    As `transform`, but without blocking the event loop: pdf2htmlEX runs as an asyncio subprocess, and everything else
+    (hashing for the cache, parsing and post-processing the output) runs in `executor` (the loop's default if None).
+    Failures raise exceptions, such as `ConversionError` if pdf2htmlEX fails, rather than exiting.
+
+    At most `semaphore` pdf2htmlEX processes run at once, counting each shard of a conversion split into `jobs`; by
+    default, `MAX_CONCURRENT_CONVERSIONS` per event loop. If pdf2htmlEX takes longer than `timeout` seconds (including
+    any wait for the semaphore), `asyncio.TimeoutError` is raised. On timeout or cancellation, pdf2htmlEX is killed.
+    """
+    if pdf2html is None:
+        pdf2html = os.path.join(os.path.dirname(__file__), '../pdf2htmlex.appimage')
+    if not os.path.isfile(pdf2html):
+        raise FileNotFoundError(f'Cannot run pdf2html; {pdf2html} is not a file')
+    loop = asyncio.get_running_loop()
+    if semaphore is None:
+        semaphore = _semaphores.get(loop)
+        if semaphore is None:
+            semaphore = _semaphores[loop] = asyncio.Semaphore(MAX_CONCURRENT_CONVERSIONS)
+    def in_executor(func, *args):
+        # Carry the current span over, so that spans in the executor nest under it
+        return loop.run_in_executor(executor, partial(copy_context().run, func, *args))
+    with span('make_html'):
+        conversion = _Conversion(input_path, output_path, pdf2html=pdf2html, pdf2html_options=pdf2html_options, no_scripts=no_scripts, no_ui=no_ui, do_form=do_form, zoom=zoom, jobs=jobs, streaming=streaming, cache=cache, cache_dir=cache_dir, field_index=field_index, split_pages=split_pages, asset_dir=asset_dir, asset_url=asset_url)
+        with conversion.cleanup:
+            await in_executor(conversion.prepare)
+            if await in_executor(conversion.lookup):
+                return
+            with span('make_html.pdf2htmlex', jobs=jobs):
+                if jobs > 1:
+                    from .shard import plan_shards, write_merged
+                    with tempfile.TemporaryDirectory() as temp_dir:
+                        shards = await in_executor(plan_shards, pdf2html_options, conversion.input_path, temp_dir, jobs)
+                        commands = [conversion.command(options=options, output_path=shard_path) for options, shard_path in shards]
+                        await asyncio.wait_for(_run_all(commands, conversion.pass_fds, semaphore), timeout)
+                        await in_executor(write_merged, [shard_path for _, shard_path in shards], conversion.output_path)
+                else:
+                    await asyncio.wait_for(_run_all([conversion.command()], conversion.pass_fds, semaphore), timeout)
+            await in_executor(conversion.post_process)
+
+async def _run_all(commands, pass_fds, semaphore):
+    """Run each command, raising `ConversionError` for the first to fail, after stopping the rest."""
+    tasks = [asyncio.ensure_future(_run_async(command, pass_fds, semaphore)) for command in commands]
+    try:
+        # Failures are raised by the task itself, so that gather gives up on the rest as soon as one fails
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def _run_async(command, pass_fds, semaphore):
+    async with semaphore:
+        # In a session of its own, so that anything it starts in turn (like an AppImage's payload) can be killed with it
+        process = await asyncio.create_subprocess_exec(*command, pass_fds=pass_fds, start_new_session=True)
+        try:
+            returncode = await process.wait()
+        except BaseException:
+            if process.returncode is None:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                await process.wait()
+            raise
+    if returncode != 0:
+        raise ConversionError(returncode)
+
+def _finish(soup, output, *, source_dir, assets, split_pages):
+    """Move the document's assets into the shared store and/or split out its pages, writing the result to `output`."""
+    if assets is not None:
+        from .assets import extract_assets
+        extract_assets(soup, assets, source_dir)
+    if split_pages:
+        from .split import split_pages as write_split_pages
+        write_split_pages(soup, output)
+    elif isinstance(output, IOBase):
+        output.write(str(soup))
+    else:
+        with open(output, 'w') as file:
+            file.write(str(soup))
+
+def _finish_file(output_path, output_file, **kwargs):
+    with open(output_path, 'r') as file:
+        soup = BeautifulSoup(file.read(), 'lxml')
+    _finish(soup, output_file or output_path, source_dir=os.path.dirname(output_path), **kwargs)
+
+def _tmpfs():
+    """A memory-backed directory for temporary files, if there is one, otherwise None for the default."""
+    return '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+
+@contextmanager
+def _input_file(stream):
+    """
+    Give the PDF in `stream` a path that pdf2htmlEX and the other readers can open, without writing it to disk.
+    Yields the path, and the file descriptors that child processes need to keep open for it to work.
+
+    On Linux, the PDF goes into an anonymous memory file opened through `/dev/fd`. Elsewhere, it goes into a temporary
+    file that is kept open (and so in place) until done with.
+    """
+    binary = not isinstance(stream, TextIOBase)
+    if hasattr(os, 'memfd_create') and os.path.isdir('/dev/fd'):
+        fd = os.memfd_create('transformer-input')
+        try:
+            with open(fd, 'wb' if binary else 'w', closefd=False) as file:
+                copyfileobj(stream, file)
+            yield f'/dev/fd/{fd}', (fd,)
+        finally:
+            os.close(fd)
+        return
+    with tempfile.NamedTemporaryFile('wb' if binary else 'w', suffix='.pdf', dir=_tmpfs()) as file:
+        copyfileobj(stream, file)
+        file.flush()
+        yield file.name, ()
+
+def _rewrite_streaming(field_index, output_path, output_file, *, no_scripts, no_ui, do_form, zoom):
+    from .stream import rewrite
+    form_inputs = None
+    if do_form:
+        from .process_form import collect_form_inputs, FORM_STYLE
+        form_inputs = collect_form_inputs(field_index, zoom)
+    options = dict(no_scripts=no_scripts, no_ui=no_ui, form_inputs=form_inputs, head_extra=f'<style>{FORM_STYLE}</style>' if form_inputs is not None else '')
+    with open(output_path, 'r') as file:
+        if output_file is not None:
+            rewrite(file, output_file, **options)
+            return
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(output_path)), delete=False) as temp_out:
+            try:
+                rewrite(file, temp_out, **options)
+            except BaseException:
+                os.remove(temp_out.name)
+                raise
+    os.replace(temp_out.name, output_path)
@@ -0,0 +1,130 @@
+from __future__ import annotations
+import os, re
+import binascii
+import tempfile
+from base64 import b64decode
+from hashlib import sha256
+from urllib.parse import unquote_to_bytes
+from bs4 import BeautifulSoup
+from ..instrument import span
+
+# Inline styles and scripts smaller than this (in bytes) are left in the document, as not worth a request of their own
+ASSET_MIN_BYTES = 1024
+
+_css_url = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+_extensions = {
+    'application/font-woff': '.woff',
+    'application/x-font-woff': '.woff',
+    'font/woff': '.woff',
+    'font/woff2': '.woff2',
+    'application/x-font-ttf': '.ttf',
+    'font/ttf': '.ttf',
+    'application/x-font-otf': '.otf',
+    'font/otf': '.otf',
+    'application/vnd.ms-fontobject': '.eot',
+    'image/png': '.png',
+    'image/jpeg': '.jpg',
+    'image/gif': '.gif',
+    'image/svg+xml': '.svg',
+    'image/webp': '.webp',
+    'text/css': '.css',
+    'text/javascript': '.js',
+    'application/javascript': '.js',
+}
+
+
+class AssetStore:
+    """
+    A directory of assets shared between converted documents, each named by a hash of its content, so that the same
+    font or stylesheet is only stored (and downloaded) once however many documents use it. `url` is where documents
+    refer to the directory.
+
+    An asset's name changes whenever its content does, so the directory can be served with a far-future cache lifetime,
+    e.g. `Cache-Control: public, max-age=31536000, immutable`.
+    """
+    def __init__(self, directory, url):
+        self.directory = directory
+        self.url = url.rstrip('/') + '/'
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, data: bytes, extension=''):
+        """Add an asset to the store, if it is not there already, returning its name."""
+        name = sha256(data).hexdigest()[:32] + extension
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            with tempfile.NamedTemporaryFile('wb', dir=self.directory, suffix='.tmp', delete=False) as temp:
+                temp.write(data)
+            # Temporary files are private to the user, but assets are for serving
+            os.chmod(temp.name, 0o644)
+            os.replace(temp.name, path)
+        return name
+
+    def add_url(self, url, source_dir=None):
+        """
+        Add the asset at `url` to the store, returning its name, or None if it is neither a data URI nor the path of a
+        file in `source_dir`. Stylesheets have the assets they refer to added as well.
+        """
+        if url.startswith('data:'):
+            header, _, payload = url.partition(',')
+            mime, *params = header[5:].split(';')
+            try:
+                data = b64decode(payload) if 'base64' in params else unquote_to_bytes(payload)
+            except binascii.Error:
+                return None # Leave anything mangled where it is
+            extension = _extensions.get(mime.lower(), '')
+            if extension == '.css':
+                data = self.rewrite_css(data.decode(), '', source_dir).encode()
+            return self.add(data, extension)
+        if source_dir is None or ':' in url or url.startswith(('/', '#')):
+            return None
+        path = os.path.join(source_dir, url.split('#')[0].split('?')[0])
+        if not os.path.isfile(path):
+            return None
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.css':
+            with open(path, 'r') as file:
+                return self.add(self.rewrite_css(file.read(), '', os.path.dirname(path)).encode(), extension)
+        with open(path, 'rb') as file:
+            return self.add(file.read(), extension)
+
+    def rewrite_css(self, css, prefix, source_dir=None):
+        """Move the assets that `css` refers to into the store, referring to them by their names after `prefix`."""
+        def replace(match):
+            name = self.add_url(match[2].strip(), source_dir)
+            return match[0] if name is None else f'url({match[1]}{prefix}{name}{match[1]})'
+        return _css_url.sub(replace, css)
+
+
+@span('make_html.extract_assets')
+def extract_assets(soup: BeautifulSoup, store: AssetStore, source_dir=None):
+    """
+    Move the fonts, images, stylesheets and scripts of a document into `store`, and point the document at them there.
+    This covers embedded assets (data URIs, and inline styles and scripts of at least `ASSET_MIN_BYTES`), as well as
+    any files in `source_dir` that pdf2htmlEX wrote alongside the document rather than embedding.
+    """
+    for tag, attr in (('img', 'src'), ('script', 'src'), ('link', 'href')):
+        for el in soup.find_all(tag, attrs={attr: True}):
+            if tag == 'link' and 'stylesheet' not in el.get('rel', ()):
+                continue
+            name = store.add_url(el[attr], source_dir)
+            if name is not None:
+                el[attr] = store.url + name
+    for el in soup.find_all('style'):
+        css = el.string or ''
+        # Within the store, stylesheets refer to other assets by name alone
+        stored_css = store.rewrite_css(css, '', source_dir)
+        if len(stored_css.encode()) >= ASSET_MIN_BYTES:
+            link = soup.new_tag('link', rel='stylesheet', href=store.url + store.add(stored_css.encode(), '.css'))
+            if el.get('media'):
+                link['media'] = el['media']
+            el.replace_with(link)
+        elif stored_css != css:
+            el.string = store.rewrite_css(css, store.url, source_dir)
+    for el in soup.find_all('script', src=False):
+        if el.get('type', 'text/javascript') not in ('text/javascript', 'application/javascript', 'module'):
+            continue
+        script = (el.string or '').encode()
+        if len(script) >= ASSET_MIN_BYTES:
+            el.string = ''
+            el['src'] = store.url + store.add(script, '.js')
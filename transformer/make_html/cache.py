@@ -0,0 +1,113 @@
+from __future__ import annotations
+import os
+import json
+import tempfile
+from hashlib import sha256
+from io import IOBase
+from shutil import copyfileobj
+from .field_renderer import FieldRenderer
+
+# Default maximum total size of the cached conversions, in bytes
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# Part of every cache key; bump it whenever a change to post-processing changes the output for the same inputs
+CACHE_VERSION = 2
+
+
+def default_cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'transformer', 'make-html')
+
+
+class ConversionCache:
+    """
+    On-disk cache of finished make-html conversions, addressed by a hash of the PDF and everything that affects the
+    output. Once the cache grows past `max_bytes`, the least recently used conversions are evicted.
+    """
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, pdf_path, pdf2html, pdf2html_options, **options):
+        """
+        Build the cache key for converting `pdf_path`. The pdf2htmlEX binary is identified by its path, size and
+        modification time, which change with any upgrade, rather than by running it to ask for its version.
+        """
+        digest = sha256()
+        with open(pdf_path, 'rb') as pdf_file:
+            for chunk in iter(lambda: pdf_file.read(1 << 20), b''):
+                digest.update(chunk)
+        pdf2html = os.path.realpath(pdf2html)
+        stat = os.stat(pdf2html)
+        renderer = FieldRenderer._renderer_type or FieldRenderer
+        digest.update(json.dumps({
+            'pdf2html': [pdf2html, stat.st_size, stat.st_mtime_ns],
+            'pdf2html_options': list(pdf2html_options),
+            'renderer': f'{renderer.__module__}.{renderer.__qualname__}',
+            'version': CACHE_VERSION,
+            **options,
+        }, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.html')
+
+    def fetch(self, key, output):
+        """Copy the cached conversion for `key` to `output` (a path or text stream), returning False if there is none."""
+        path = self.path(key)
+        try:
+            file = open(path, 'r')
+        except FileNotFoundError:
+            return False
+        with file:
+            # Bump the modification time, which is what eviction goes by
+            try:
+                os.utime(path)
+            except OSError:
+                pass # A read-only cache still works, it just evicts by age
+            if isinstance(output, IOBase):
+                copyfileobj(file, output)
+            else:
+                with open(output, 'w') as output_file:
+                    copyfileobj(file, output_file)
+        return True
+
+    def store(self, key, html_path):
+        """Add the finished conversion at `html_path` to the cache, then evict as needed to stay under the size cap."""
+        with open(html_path, 'r') as file:
+            self._store(key, lambda temp: copyfileobj(file, temp))
+
+    def store_html(self, key, html):
+        """As `store`, but given the finished conversion itself rather than a file holding it."""
+        self._store(key, lambda temp: temp.write(html))
+
+    def _store(self, key, write):
+        with tempfile.NamedTemporaryFile('w', dir=self.cache_dir, suffix='.tmp', delete=False) as temp:
+            try:
+                write(temp)
+            except BaseException:
+                temp.close()
+                os.remove(temp.name)
+                raise
+        try:
+            os.replace(temp.name, self.path(key))
+        except BaseException:
+            os.remove(temp.name)
+            raise
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.html'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass # Already evicted by another process
+            total -= size
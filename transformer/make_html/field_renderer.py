@@ -1,4 +1,5 @@
 from html import escape
+from string import Formatter
 
 class FieldRenderer:
     """
@@ -10,6 +11,42 @@ class FieldRenderer:
     label: str
     style: dict
 
+    # The output for each input type. Each {part} is filled with the result of the renderer's render_{part}() method.
+    # These are compiled once per class; override either them or the render_{type}() methods to customize the output.
+    templates = {
+        'button': "",
+        'checkbox': "<input type='checkbox' {basic_attrs} {value_checked_if}/>",
+        'file': "",
+        'password': "<input type='password' {basic_attrs} {value_attr}/>",
+        'radio': "<input type='radio' {basic_attrs} {value_checked_if}/>",
+        'select': "",
+        'signature': "<input type='file' data-real-type='signature' {basic_attrs}/>",
+        'text': "<input type='text' {basic_attrs} {value_attr}/>",
+        'textarea': "<textarea {basic_attrs}>{value_content}</textarea>",
+    }
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._compile()
+
+    @classmethod
+    def _compile(cls):
+        """Compile this class's templates, and build its dispatch table of input type to render function."""
+        cls._compiled = {}
+        cls._dispatch = {}
+        for type, template in cls.templates.items():
+            parts = tuple(
+                (literal, getattr(cls, f'render_{part}') if part else None)
+                for literal, part, _, _ in Formatter().parse(template)
+            )
+            cls._compiled[type] = lambda self, parts=parts: ''.join([literal + render(self) if render else literal for literal, render in parts])
+            method = getattr(cls, f'render_{type}', None)
+            # Use the compiled template directly, unless the render method for this type has been overridden
+            if method is None or method is getattr(FieldRenderer, f'render_{type}', None):
+                cls._dispatch[type] = cls._compiled[type]
+            else:
+                cls._dispatch[type] = method
+
     @classmethod
     def set_render_type(cls, renderer):
         if not issubclass(renderer, cls):
@@ -23,25 +60,10 @@ class FieldRenderer:
         return renderer
 
     def render(self):
-        if self.type == 'button':
-            return self.render_button()
-        if self.type == 'checkbox':
-            return self.render_checkbox()
-        if self.type == 'file':
-            return self.render_file()
-        if self.type == 'password':
-            return self.render_password()
-        if self.type == 'radio':
-            return self.render_radio()
-        if self.type == 'select':
-            return self.render_select()
-        if self.type == 'signature':
-            return self.render_signature()
-        if self.type == 'text':
-            return self.render_text()
-        if self.type == 'textarea':
-            return self.render_textarea()
-        raise ValueError(f'Unknown input type: {self.type}')
+        render = self._dispatch.get(self.type)
+        if render is None:
+            raise ValueError(f'Unknown input type: {self.type}')
+        return render(self)
 
     def render_style_attr_value(self):
         if self.style is None:
@@ -54,39 +76,39 @@ class FieldRenderer:
 
     def render_button(self):
         """Render a push button using the properties of this renderer"""
-        return f""""""
+        return self._compiled['button'](self)
 
     def render_checkbox(self):
         """Render a checkbox using the properties of this renderer"""
-        return f"""<input type='checkbox' {self.render_basic_attrs()} {self.render_value_checked_if()}/>"""
+        return self._compiled['checkbox'](self)
 
     def render_file(self):
         """Render a file input using the properties of this renderer"""
-        return f""""""
+        return self._compiled['file'](self)
 
     def render_password(self):
         """Render a password input using the properties of this renderer"""
-        return f"""<input type='password' {self.render_basic_attrs()} {self.render_value_attr()}/>"""
+        return self._compiled['password'](self)
 
     def render_radio(self):
         """Render a radio button using the properties of this renderer"""
-        return f"""<input type='radio' {self.render_basic_attrs()} {self.render_value_checked_if()}/>"""
+        return self._compiled['radio'](self)
 
     def render_select(self):
         """Render a select element using the properties of this renderer"""
-        return f""""""
+        return self._compiled['select'](self)
 
     def render_signature(self):
         """Render a signature field using the properties of this renderer"""
-        return f"""<input type='file' data-real-type='signature' {self.render_basic_attrs()}/>"""
+        return self._compiled['signature'](self)
 
     def render_text(self):
         """Render a text field using the properties of this renderer"""
-        return f"""<input type='text' {self.render_basic_attrs()} {self.render_value_attr()}/>"""
+        return self._compiled['text'](self)
 
     def render_textarea(self):
         """Render a multiline text field using the properties of this renderer"""
-        return f"""<textarea {self.render_basic_attrs()}>{self.render_value_content()}</textarea>"""
+        return self._compiled['textarea'](self)
 
     def render_basic_attrs(self):
         """Render the basic attributes (name and style) to apply to the field, regardless of type."""
@@ -130,4 +152,7 @@ class JinjaFieldRenderer(FieldRenderer):
         return f"""{{% if {self.render_template_value_variable()} %}}{{{{{self.render_template_value_variable()} | e}}}}{{% endif %}}"""
     
     def render_value_checked_if(self):
-        return f"""{{% if {self.render_template_value_variable()} %}}checked{{% endif %}}"""
\ No newline at end of file
+        return f"""{{% if {self.render_template_value_variable()} %}}checked{{% endif %}}"""
+
+
+FieldRenderer._compile()
\ No newline at end of file
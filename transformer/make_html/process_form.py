@@ -1,67 +1,72 @@
 from __future__ import annotations
-from collections import defaultdict
 from bs4 import BeautifulSoup
-from pypdf import PdfReader
-from pypdf.constants import FieldDictionaryAttributes, AnnotationDictionaryAttributes
-from pypdf.generic import RectangleObject, Field
+from bs4.element import PreformattedString
+from pypdf.constants import FieldDictionaryAttributes
+from ..field_index import FieldIndex, FieldInfo
 from .field_renderer import FieldRenderer
+from ..instrument import span
+
+FORM_STYLE = """
+        .form-inputs{
+            bottom: -3px;
+            left: -4px;
+            position: absolute;
+        }
+        .form-inputs input,
+        .form-inputs textarea,
+        .form-inputs select{
+            border: none;
+            background: rgba(0,0,0,.05);
+            resize: none;
+        }
+    """
+
+def input_type(field: FieldInfo):
+    """Get the type of input (as understood by `FieldRenderer`) to use for a field, or None if it has no equivalent."""
+    flags = field.flags or 0
+    if field.type == "/Btn":
+        if flags & FieldDictionaryAttributes.FfBits.Radio:
+            return 'radio'
+        elif flags & FieldDictionaryAttributes.FfBits.Pushbutton:
+            return 'button'
+        else: # field is checkbox
+            return 'checkbox'
+    elif field.type == "/Tx":
+        if flags & FieldDictionaryAttributes.FfBits.Multiline:
+            return 'textarea'
+        elif flags & FieldDictionaryAttributes.FfBits.Password:
+            return 'password'
+        elif flags & FieldDictionaryAttributes.FfBits.FileSelect:
+            return 'file'
+        else:
+            return 'text'
+    elif field.type ==  "/Ch":
+        return 'select'
+    elif field.type == "/Sig":
+        return 'signature'
+    return None
 
 # See https://pdfminersix.readthedocs.io/en/latest/howto/acro_forms.html
-def process_form(pdf_filename: str, soup: BeautifulSoup, zoom: int = 1, rename_fields = {}, field_labels = {}):
-    with open(pdf_filename, 'rb') as pdf_file:
-        parser = PdfReader(pdf_file)
-        fields = parser.get_fields()
-        if not fields:
-            return {} # No form found, so nothing to do
-        html_form = soup.find(id='page-container').wrap(soup.new_tag('form'))
-        html_pages = html_form.find_all(class_='pf')
-        rendered_fields = {}
-        i = 0
-        for page_no, pdf_page in enumerate(parser.pages):
-            if pdf_page.annotations is None: continue
-            html_page = html_pages[page_no]
-            fieldset = soup.new_tag('div', attrs={'class':'form-inputs'})
-            for annot in pdf_page.annotations:
-                annot = annot.get_object()
-                # All field widgets are annotations with type "widget"
-                # See 12.5.6.19 at https://opensource.adobe.com/dc-acrobat-sdk-docs/pdfstandards/PDF32000_2008.pdf
-                if annot[AnnotationDictionaryAttributes.Subtype] != "/Widget":
-                    continue
-                # Actual field data *may* use the same dictionary as the widget, but may not. 
-                # E.g. for radio groups the parent is the field, and the children are the widgets
-                # Docs seem to indicate that /Parent should be absent when the annotation is the field,
-                # at least as I read it, but in practice this does not seem to actually be the case.
-                # So instead, I'm guessing based on the FT (field type, see 12.7.3.1)
-                if FieldDictionaryAttributes.FT in annot:
-                    field = Field(annot)
-                elif FieldDictionaryAttributes.Parent in annot and FieldDictionaryAttributes.FT in annot[FieldDictionaryAttributes.Parent].get_object():
-                    field = Field(annot[FieldDictionaryAttributes.Parent].get_object())
-                else:
-                    # I don't think this should ever happen, but if so I guess skip this widget
-                    continue
-                i += 1
-                if field.field_type == "/Btn":
-                    if (field.flags or 0) & FieldDictionaryAttributes.FfBits.Radio:
-                        input = FieldRenderer.make('radio')
-                    elif (field.flags or 0) & FieldDictionaryAttributes.FfBits.Pushbutton:
-                        input = FieldRenderer.make('button')
-                    else: # field is checkbox
-                        input = FieldRenderer.make('checkbox')
-                elif field.field_type == "/Tx":
-                    if (field.flags or 0) & FieldDictionaryAttributes.FfBits.Multiline:
-                        input = FieldRenderer.make('textarea')
-                    elif (field.flags or 0) & FieldDictionaryAttributes.FfBits.Password:
-                        input = FieldRenderer.make('password')
-                    elif (field.flags or 0) & FieldDictionaryAttributes.FfBits.FileSelect:
-                        input = FieldRenderer.make('file')
-                    else:
-                        input = FieldRenderer.make('text')
-                elif field.field_type ==  "/Ch":
-                    input = FieldRenderer.make('select')
-                elif field.field_type == "/Sig":
-                    input = FieldRenderer.make('signature')
-                else:
+def collect_form_inputs(pdf: str | FieldIndex, zoom: int = 1, rename_fields = {}, field_labels = {}):
+    """
+    Render an input for each form field widget in the PDF (given as a filename, or an already built `FieldIndex`),
+    returning a dict of (0-based) page number to the list of rendered inputs on that page, or None if the PDF has no
+    form at all.
+    """
+    index = pdf if isinstance(pdf, FieldIndex) else FieldIndex.from_pdf(pdf)
+    if not index.fields:
+        return None # No form found, so nothing to do
+    inputs = {}
+    with span('process_form.render', fields=len(index.fields)) as current:
+        for page_no, widgets in enumerate(index.pages):
+            if not widgets: continue
+            page_inputs = inputs[page_no] = []
+            for widget in widgets:
+                field = index.fields[widget.field]
+                type = input_type(field)
+                if type is None:
                     continue
+                input = FieldRenderer.make(type)
                 name = field.name
                 if name in rename_fields:
                     input.name = rename_fields[name]
@@ -71,34 +76,41 @@ def process_form(pdf_filename: str, soup: BeautifulSoup, zoom: int = 1, rename_f
                     input.label = field_labels[name]
                 else:
                     input.label = field.alternate_name
-                rect = RectangleObject(annot[AnnotationDictionaryAttributes.Rect])
-                rect = rect.scale(zoom, zoom)
                 # The PDF format considers the bottom-left corner to be the origin, so we use that to place
                 input.style = {
                     'position': 'absolute',
-                    'left': f'{rect.left}px',
-                    'bottom': f'{rect.bottom}px',
-                    'width': f'{rect.width}px',
-                    'height': f'{rect.height}px',
+                    'left': f'{widget.left * zoom}px',
+                    'bottom': f'{widget.bottom * zoom}px',
+                    'width': f'{widget.width * zoom}px',
+                    'height': f'{widget.height * zoom}px',
                 }
-                placeholder_name = f'field{i}'
-                rendered_fields[placeholder_name] = input.render()
-                fieldset.append(f'\n${{{placeholder_name}}}\n')
-            html_page.append(fieldset)
+                page_inputs.append(input.render())
+        current.count('inputs', sum(len(page_inputs) for page_inputs in inputs.values()))
+    return inputs
+
+
+class RawHTML(PreformattedString):
+    """Markup to be output exactly as-is when the soup is serialized, without being parsed or escaped."""
+
+
+@span('process_form')
+def process_form(pdf: str | FieldIndex, soup: BeautifulSoup, zoom: int = 1, rename_fields = {}, field_labels = {}):
+    """
+    Wrap the page container in a form, and add the rendered inputs to each page. The inputs are added as raw markup,
+    spliced into the output when the soup is serialized. Returns the inputs added to each page.
+    """
+    inputs = collect_form_inputs(pdf, zoom, rename_fields, field_labels)
+    if inputs is None:
+        return {}
+    html_form = soup.find(id='page-container').wrap(soup.new_tag('form'))
+    # pdf2htmlEX numbers pages (in hex) by their page number in the PDF, even when only converting some of them
+    html_pages = {int(page['data-page-no'], 16) - 1: page for page in html_form.find_all(class_='pf')}
+    for page_no, page_inputs in inputs.items():
+        if page_no not in html_pages: continue
+        fieldset = soup.new_tag('div', attrs={'class':'form-inputs'})
+        fieldset.append(RawHTML(''.join(f'\n{rendered}\n' for rendered in page_inputs)))
+        html_pages[page_no].append(fieldset)
     style = soup.new_tag('style')
-    style.append("""
-        .form-inputs{
-            bottom: -3px;
-            left: -4px;
-            position: absolute;
-        }
-        .form-inputs input,
-        .form-inputs textarea,
-        .form-inputs select{
-            border: none;
-            background: rgba(0,0,0,.05);
-            resize: none;
-        }
-    """)
+    style.append(FORM_STYLE)
     soup.find('head').append(style)
-    return rendered_fields
\ No newline at end of file
+    return inputs
@@ -0,0 +1,99 @@
+from __future__ import annotations
+import os, re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import run
+from bs4 import BeautifulSoup
+from pypdf import PdfReader
+
+# Class names pdf2htmlEX numbers per document (font family/size, colors, spacing, positions, transforms, etc...).
+# Each shard numbers these independently, so all but the first shard's need renaming before they can be merged.
+_numbered_class = re.compile(r'^(ff|fs|fc|sc|ls|ws|_|v|x|y|w|h|m|c)[0-9a-f]+$')
+_numbered_css = re.compile(r'(\.|font-family:)((?:ff|fs|fc|sc|ls|ws|_|v|x|y|w|h|m|c)[0-9a-f]+)\b')
+
+
+def page_ranges(first, last, shards):
+    """Split the pages from `first` to `last` (inclusive) into at most `shards` contiguous ranges."""
+    per_shard = -(-(last - first + 1) // shards)
+    return [(start, min(start + per_shard - 1, last)) for start in range(first, last + 1, per_shard)]
+
+
+def plan_shards(pdf2html_options, input_path, temp_dir, jobs):
+    """
+    Split the conversion of a PDF into at most `jobs` ranges of pages, honoring any -f/-l in `pdf2html_options`.
+    Returns the pdf2htmlEX options and output path in `temp_dir` for each shard.
+    """
+    options = list(pdf2html_options)
+    first, last = 1, None
+    for flag in ('-f', '--first-page', '-l', '--last-page'):
+        while flag in options:
+            i = options.index(flag)
+            if flag in ('-f', '--first-page'):
+                first = int(options[i + 1])
+            else:
+                last = int(options[i + 1])
+            del options[i:i + 2]
+    with open(input_path, 'rb') as pdf_file:
+        page_count = len(PdfReader(pdf_file).pages)
+    last = page_count if last is None else min(last, page_count)
+    ranges = page_ranges(first, last, jobs) or [(first, last)]
+    return [
+        ([*options, '-f', str(start), '-l', str(end)], os.path.join(temp_dir, f'shard{shard_no}.html'))
+        for shard_no, (start, end) in enumerate(ranges)
+    ]
+
+
+def run_sharded(pdf2html, pdf2html_options, input_path, output_path, jobs, *, pass_fds=()):
+    """
+    Convert a PDF by running several instances of pdf2htmlEX in parallel, each on its own range of pages, then merge
+    the results into a single document at `output_path`.
+
+    Honors any -f/-l in `pdf2html_options`. Assets must be embedded (pdf2htmlEX's default), since each shard is
+    converted in its own temporary directory. `pass_fds` are kept open in each pdf2htmlEX process, as for
+    `subprocess.run`. Returns the non-zero exit code of the first shard to fail, or 0.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        shards = plan_shards(pdf2html_options, input_path, temp_dir, jobs)
+        def convert(shard):
+            options, shard_path = shard
+            return run([pdf2html, *options, input_path, shard_path], pass_fds=pass_fds).returncode
+        with ThreadPoolExecutor(jobs) as executor:
+            returncodes = list(executor.map(convert, shards))
+        for returncode in returncodes:
+            if returncode != 0:
+                return returncode
+        write_merged([shard_path for _, shard_path in shards], output_path)
+    return 0
+
+
+def write_merged(shard_paths, output_path):
+    """Merge the converted shards (see `merge_shards`), writing the result to `output_path`."""
+    merged = merge_shards(shard_paths)
+    with open(output_path, 'w') as file:
+        file.write(str(merged))
+
+
+def merge_shards(shard_paths):
+    """Merge the pages, styles and scripts of several pdf2htmlEX documents into the first one."""
+    with open(shard_paths[0], 'r') as file:
+        soup = BeautifulSoup(file.read(), 'lxml')
+    head = soup.find('head')
+    container = soup.find(id='page-container')
+    seen = {str(el) for el in head.find_all(['style', 'script'])}
+    for shard_no, shard_path in enumerate(shard_paths[1:], 1):
+        with open(shard_path, 'r') as file:
+            shard = BeautifulSoup(file.read(), 'lxml')
+        suffix = f's{shard_no}'
+        for el in shard.find('head').find_all(['style', 'script']):
+            if el.name == 'style':
+                el.string = _numbered_css.sub(lambda m: f'{m[1]}{m[2]}{suffix}', el.string or '')
+            if str(el) in seen:
+                # Shared boilerplate, such as pdf2htmlEX's base CSS and JS
+                continue
+            seen.add(str(el))
+            head.append(el.extract())
+        for page in shard.find(id='page-container').find_all(class_='pf', recursive=False):
+            for el in [page, *page.find_all(class_=True)]:
+                el['class'] = [f'{cls}{suffix}' if _numbered_class.match(cls) else cls for cls in el['class']]
+            container.append(page.extract())
+    return soup
@@ -0,0 +1,91 @@
+from __future__ import annotations
+import os
+from bs4 import BeautifulSoup
+from ..instrument import span
+
+# Loads each page as it nears the visible part of the page container, unless pdf2htmlEX's own viewer is there to do so.
+# Either way, any pages still unloaded when the form is submitted are loaded first, so that their fields are submitted.
+LOADER_SCRIPT = """
+(function(){
+    var load = function(page){
+        var url = page.getAttribute('data-page-url');
+        page.removeAttribute('data-page-url');
+        return fetch(url).then(function(response){
+            if (!response.ok) throw new Error(response.statusText);
+            return response.text();
+        }).then(function(html){
+            var holder = document.createElement('div');
+            holder.innerHTML = html;
+            if (page.parentNode) page.parentNode.replaceChild(holder.firstElementChild, page);
+        }).catch(function(){
+            page.setAttribute('data-page-url', url);
+        });
+    };
+    var unloaded = function(){ return document.querySelectorAll('.pf[data-page-url]'); };
+    document.addEventListener('submit', function(event){
+        var form = event.target, pages = unloaded();
+        if (!pages.length) return;
+        event.preventDefault();
+        var submitter = event.submitter;
+        Promise.all(Array.prototype.map.call(pages, load)).then(function(){
+            if (unloaded().length) {
+                alert('Some pages of the form could not be loaded. Please try again.');
+                return;
+            }
+            if (submitter && submitter.name) {
+                var input = document.createElement('input');
+                input.type = 'hidden';
+                input.name = submitter.name;
+                input.value = submitter.value;
+                form.appendChild(input);
+            }
+            form.submit();
+        });
+    }, true);
+    if (window.pdf2htmlEX && pdf2htmlEX.defaultViewer) return;
+    var pages = unloaded();
+    if (!window.IntersectionObserver) {
+        Array.prototype.forEach.call(pages, load);
+        return;
+    }
+    var observer = new IntersectionObserver(function(entries){
+        entries.forEach(function(entry){
+            if (!entry.isIntersecting || !entry.target.hasAttribute('data-page-url')) return;
+            observer.unobserve(entry.target);
+            load(entry.target);
+        });
+    }, {root: document.getElementById('page-container'), rootMargin: '100% 0px'});
+    Array.prototype.forEach.call(pages, function(page){ observer.observe(page); });
+})();
+"""
+
+
+def pages_dir(output_path):
+    """The directory the page fragments for the document at `output_path` are written to."""
+    return f'{os.path.splitext(output_path)[0]}.pages'
+
+
+@span('make_html.split_pages')
+def split_pages(soup: BeautifulSoup, output_path):
+    """
+    Write each page of the document (along with its form inputs) to its own fragment, and the rest of the document,
+    with empty placeholders for the pages, to `output_path`. The placeholders keep the size of their pages, and follow
+    pdf2htmlEX's own convention for split pages, so that its viewer loads them as they scroll into view; without the
+    viewer, a small script is added to do the same. The script also loads any pages still unloaded when the form is
+    submitted, so that the fields on every page are submitted. Returns the number of pages split out.
+    """
+    directory = pages_dir(output_path)
+    os.makedirs(directory, exist_ok=True)
+    pages = soup.find(id='page-container').find_all(class_='pf')
+    for page in pages:
+        name = f"{int(page['data-page-no'], 16)}.html"
+        with open(os.path.join(directory, name), 'w') as file:
+            file.write(str(page))
+        page.clear()
+        page['data-page-url'] = f'{os.path.basename(directory)}/{name}'
+    script = soup.new_tag('script')
+    script.string = LOADER_SCRIPT
+    (soup.find('body') or soup).append(script)
+    with open(output_path, 'w') as file:
+        file.write(str(soup))
+    return len(pages)
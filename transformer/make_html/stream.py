@@ -0,0 +1,115 @@
+from __future__ import annotations
+from html.parser import HTMLParser
+
+# Elements that never have an end tag
+_void_elements = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+
+
+class StreamingRewriter(HTMLParser):
+    """
+    Single-pass rewriter for pdf2htmlEX output, as an alternative to a full BeautifulSoup round trip.
+
+    Markup is copied through to `out_file` as it is parsed, except for the changes requested, so memory use is bounded
+    by the largest single tag (e.g. an embedded background image) rather than by the size of the document.
+
+    `form_inputs` is a dict of (0-based) page number to the rendered inputs to add to that page, as returned by
+    `collect_form_inputs`. If given, `#page-container` is also wrapped in a form, and `head_extra` is added to the head.
+    """
+    def __init__(self, out_file, *, no_scripts=False, no_ui=False, form_inputs=None, head_extra=''):
+        super().__init__(convert_charrefs=False)
+        self.out_file = out_file
+        self.no_scripts = no_scripts
+        self.no_ui = no_ui
+        self.form_inputs = form_inputs
+        self.head_extra = head_extra
+        # Open elements, as (tag, action) pairs
+        self.stack = []
+        # Index in the stack of the element being dropped, if any
+        self.skip_from = None
+
+    def rewrite(self, in_file, chunk_size=1 << 16):
+        for chunk in iter(lambda: in_file.read(chunk_size), ''):
+            self.feed(chunk)
+        self.close()
+
+    def write(self, text):
+        if self.skip_from is None:
+            self.out_file.write(text)
+
+    def _action(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'script' and self.no_scripts:
+            return 'skip'
+        if self.no_ui and (attrs.get('id') == 'sidebar' or 'loading-indicator' in (attrs.get('class') or '').split()):
+            return 'skip'
+        if self.form_inputs is not None:
+            if attrs.get('id') == 'page-container':
+                return 'form'
+            if 'pf' in (attrs.get('class') or '').split() and 'data-page-no' in attrs:
+                return int(attrs['data-page-no'], 16) - 1
+        return None
+
+    def handle_starttag(self, tag, attrs):
+        action = self._action(tag, attrs)
+        if tag in _void_elements:
+            if action != 'skip':
+                self.write(self.get_starttag_text())
+            return
+        if action == 'skip' and self.skip_from is None:
+            self.skip_from = len(self.stack)
+        if action == 'form':
+            self.write('<form>')
+        self.write(self.get_starttag_text())
+        self.stack.append((tag, action))
+
+    def handle_startendtag(self, tag, attrs):
+        if self._action(tag, attrs) != 'skip':
+            self.write(self.get_starttag_text())
+
+    def handle_endtag(self, tag):
+        if not any(open_tag == tag for open_tag, _ in self.stack):
+            # Stray end tag; pass it through untouched
+            self.write(f'</{tag}>')
+            return
+        # Implicitly close anything left open inside this element
+        while True:
+            open_tag, action = self.stack.pop()
+            if isinstance(action, int) and self.form_inputs:
+                page_inputs = self.form_inputs.get(action)
+                if page_inputs is not None:
+                    self.write('<div class="form-inputs">' + ''.join(f'\n{rendered}\n' for rendered in page_inputs) + '</div>')
+            if open_tag == 'head' and self.form_inputs is not None:
+                self.write(self.head_extra)
+            if open_tag == tag:
+                break
+        self.write(f'</{tag}>')
+        if action == 'form':
+            self.write('</form>')
+        if self.skip_from is not None and len(self.stack) <= self.skip_from:
+            self.skip_from = None
+
+    def handle_data(self, data):
+        self.write(data)
+
+    def handle_entityref(self, name):
+        self.write(f'&{name};')
+
+    def handle_charref(self, name):
+        self.write(f'&#{name};')
+
+    def handle_comment(self, data):
+        self.write(f'<!--{data}-->')
+
+    def handle_decl(self, decl):
+        self.write(f'<!{decl}>')
+
+    def unknown_decl(self, data):
+        self.write(f'<![{data}]>')
+
+    def handle_pi(self, data):
+        self.write(f'<?{data}>')
+
+
+def rewrite(in_file, out_file, **kwargs):
+    """Stream pdf2htmlEX output from `in_file` to `out_file`, applying the changes described by `StreamingRewriter`."""
+    StreamingRewriter(out_file, **kwargs).rewrite(in_file)
@@ -0,0 +1,243 @@
+from __future__ import annotations
+import os, re
+import json
+import binascii
+import socket
+import socketserver
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from base64 import b64decode
+from io import BytesIO
+from threading import BoundedSemaphore, Lock
+from urllib.parse import urlsplit, parse_qs
+from PIL import Image
+from pypdf import PageRange
+from pypdf.errors import ParseError
+from .fill_pdf import CompiledTemplate
+from .fill_pdf.paste_img import DEFAULT_DPI
+
+# Largest request body accepted, in bytes; signature images come embedded in it
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+_template_id = re.compile(r'^[\w-][\w.-]*$')
+_content_length = re.compile(r'^[0-9]+$')
+
+
+# This worker's compiled templates, by path: ((modification time, size), template). Unlike `get_template`'s cache,
+# nothing is evicted, so every template in the directory stays warm however many there are.
+_templates = {}
+_templates_lock = Lock()
+
+def _template(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        with _templates_lock:
+            _templates.pop(path, None)
+        raise
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _templates_lock:
+        entry = _templates.get(path)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    template = CompiledTemplate(path)
+    with _templates_lock:
+        _templates[path] = (version, template)
+    return template
+
+def _warm(template_paths):
+    for path in template_paths:
+        _template(path)
+
+def _signatures(template, data):
+    for name, value in data.items():
+        field = template.fields.get(template.real_names.get(name, name))
+        if field is not None and field.type == "/Sig" and value:
+            yield name, str(value)
+
+def _unreadable_signature(template, data):
+    """The name of the first signature in `data` whose image cannot be decoded, if any."""
+    for name, value in _signatures(template, data):
+        try:
+            with Image.open(BytesIO(b64decode(value.split(',', 1)[-1]))) as img:
+                img.load()
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return name
+
+def _fill(template_path, data, output_pages, dpi):
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        template = _template(template_path)
+        for name, value in _signatures(template, data):
+            # Never let a request point the server at its own files
+            if not value.startswith('data:'):
+                raise ValueError(f"Signature field '{name}' must be given as a data: URI")
+        output = BytesIO()
+        try:
+            template.fill(output, data, output_pages=output_pages, dpi=dpi)
+        except (OSError, binascii.Error, Image.DecompressionBombError):
+            # Only worth finding out which signature failed once one has; Pillow's own message is no use to the client
+            name = _unreadable_signature(template, data)
+            if name is None:
+                raise
+            raise ValueError(f"Signature field '{name}' is not a readable image") from None
+    return output.getvalue(), [str(w.message) for w in caught]
+
+
+class FillServer:
+    """
+    Fills templates from a directory on request, keeping them parsed in memory between requests.
+
+    Fills run on a pool of `workers` processes (or, if 0, threads in this process), each keeping its own warm template
+    and signature caches. At most `queue_size` requests wait for a free worker; any more are turned away with a 503,
+    so that a burst of requests cannot pile up unbounded work. Request bodies over `max_body_bytes` are turned away
+    with a 413 before they are read.
+    """
+    def __init__(self, templates_dir, *, workers=None, queue_size=None, dpi=DEFAULT_DPI, max_body_bytes=None):
+        self.templates_dir = templates_dir
+        self.dpi = dpi
+        self.max_body_bytes = MAX_BODY_BYTES if max_body_bytes is None else max_body_bytes
+        if workers is None:
+            workers = os.cpu_count() or 1
+        template_paths = [
+            os.path.join(templates_dir, name) for name in sorted(os.listdir(templates_dir)) if name.endswith('.pdf')
+        ]
+        if workers:
+            self.executor = ProcessPoolExecutor(workers, initializer=_warm, initargs=(template_paths,))
+        else:
+            _warm(template_paths)
+            workers = 1
+            self.executor = ThreadPoolExecutor(workers)
+        self.slots = BoundedSemaphore(workers + (workers * 4 if queue_size is None else queue_size))
+
+    def template_path(self, template_id):
+        if not _template_id.match(template_id):
+            return None
+        path = os.path.join(self.templates_dir, f'{template_id}.pdf')
+        return path if os.path.isfile(path) else None
+
+    def fill(self, template_path, data, output_pages=None):
+        """Fill the template, returning the PDF bytes and any warnings, or None if the server is too busy."""
+        if not self.slots.acquire(blocking=False):
+            return None
+        try:
+            return self.executor.submit(_fill, template_path, data, output_pages, self.dpi).result()
+        finally:
+            self.slots.release()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class FillRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles `POST /fill/<template id>[?pages=<page range>]` with a JSON object of field data as the body, responding
+    with the filled PDF. Signatures must be given as data: URIs.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # Unix sockets have no client address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def send_text(self, status, message, headers={}):
+        body = f'{message}\n'.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reject(self, status, message):
+        """Respond with an error without reading the request body, so the connection cannot be reused."""
+        self.close_connection = True
+        self.send_text(status, message, {'Connection': 'close'})
+
+    def do_GET(self):
+        if urlsplit(self.path).path == '/health':
+            return self.send_text(200, 'ok')
+        self.send_text(404, 'Not found')
+
+    def do_POST(self):
+        fill_server: FillServer = self.server.fill_server
+        url = urlsplit(self.path)
+        # Check everything that can be checked before reading the body, so that a bad request costs nothing
+        if not url.path.startswith('/fill/'):
+            return self.reject(404, 'Not found')
+        template_path = fill_server.template_path(url.path[len('/fill/'):])
+        if template_path is None:
+            return self.reject(404, 'No such template')
+        output_pages = parse_qs(url.query).get('pages', [None])[0]
+        if output_pages is not None:
+            try:
+                output_pages = PageRange(output_pages)
+            except ParseError:
+                return self.reject(400, f'Invalid page range: {output_pages}')
+        content_length = self.headers.get('Content-Length', '0').strip()
+        if not _content_length.match(content_length):
+            return self.reject(400, 'Invalid Content-Length')
+        if int(content_length) > fill_server.max_body_bytes:
+            return self.reject(413, f'Request body is larger than {fill_server.max_body_bytes} bytes')
+        body = self.rfile.read(int(content_length))
+        try:
+            data = json.loads(body)
+            if not isinstance(data, dict):
+                raise ValueError('Expected a JSON object')
+        except ValueError as e:
+            return self.send_text(400, f'Invalid data: {e}')
+        try:
+            result = fill_server.fill(template_path, data, output_pages)
+        except ValueError as e:
+            return self.send_text(400, str(e))
+        except Exception as e:
+            return self.send_text(500, f'{type(e).__name__}: {e}')
+        if result is None:
+            return self.send_text(503, 'Too many requests in progress', {'Retry-After': '1'})
+        pdf, fill_warnings = result
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('Content-Length', str(len(pdf)))
+        if fill_warnings:
+            self.send_header('X-Fill-Warnings', json.dumps(fill_warnings))
+        self.end_headers()
+        self.wfile.write(pdf)
+
+
+class FillHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Let connections queue up in the kernel; the FillServer decides which of them get turned away
+    request_queue_size = 128
+
+
+class UnixFillHTTPServer(FillHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # Skip HTTPServer.server_bind, which assumes a host and port
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def serve(templates_dir, *, host='127.0.0.1', port=8080, unix_socket=None, **options):
+    """Run a `FillServer` over HTTP, on either a TCP port or a Unix socket, until interrupted."""
+    fill_server = FillServer(templates_dir, **options)
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        httpd = UnixFillHTTPServer(unix_socket, FillRequestHandler)
+    else:
+        httpd = FillHTTPServer((host, port), FillRequestHandler)
+    httpd.fill_server = fill_server
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        fill_server.shutdown()
+        if unix_socket is not None and os.path.exists(unix_socket):
+            os.remove(unix_socket)